@@ -1,17 +1,167 @@
+import numpy as np
 import pandas as pd
 
+import os
+import glob
+import asyncio
+import hashlib
+import operator
+import pickle
+import re
 import sys
+import sqlite3
+import string
 import inspect
+import threading
+import time
+import uuid
 
+from collections import OrderedDict
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from xone import utils, files, logs
+from xone import utils, files, logs, metrics, xql
+
+
+def read_arrow(data_file: str, columns=None) -> pd.DataFrame:
+    """
+    Read Arrow IPC / Feather file with memory mapping
+
+    Numeric columns without nulls are not copied, so pages of the same file are
+    shared by all processes reading it through the OS - these columns are read-only
+
+    Args:
+        data_file: file name
+        columns: list of columns to read - index is always kept
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> sample = pd.DataFrame({'price': [3000, 3010]}, index=pd.Index([1, 3], name='sid'))
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     to_arrow(sample, f'{tmp}/sample.arrow')
+        ...     data = read_arrow(f'{tmp}/sample.arrow', columns=['price'])
+        ...     data.to_dict(), data['price'].values.flags.writeable
+        ({'price': {1: 3000, 3: 3010}}, False)
+    """
+    from pyarrow import feather
+
+    table = feather.read_table(data_file, memory_map=True)
+    if columns is not None:
+        idx_cols = [
+            col for col in (table.schema.pandas_metadata or {}).get('index_columns', [])
+            if isinstance(col, str)
+        ]
+        names = set(table.column_names)
+        table = table.select(list(dict.fromkeys(
+            [col for col in columns if col in names]
+            + [col for col in idx_cols if col not in columns]
+        )))
+    return table.to_pandas(split_blocks=True)
+
+
+def to_arrow(data: pd.DataFrame, data_file: str, compression='uncompressed', compression_level=None):
+    """
+    Save DataFrame as Arrow IPC / Feather file
+    Files are uncompressed by default for memory mapped reading without copies
+    """
+    from pyarrow import feather
+
+    feather.write_feather(
+        data, data_file, compression=compression, compression_level=compression_level,
+    )
+
+
+# File headers of compressed pickles
+PKL_MAGIC = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bz2',
+    b'\xfd7zXZ\x00': 'xz',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+
+
+def read_pickle(data_file: str):
+    """
+    Read pickle file - compression is detected from file content instead of extension
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> sample = pd.DataFrame({'price': [3000, 3010]})
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     sample.to_pickle(f'{tmp}/sample.pkl', compression={'method': 'gzip'})
+        ...     read_pickle(f'{tmp}/sample.pkl').to_dict()
+        {'price': {0: 3000, 1: 3010}}
+    """
+    with open(data_file, 'rb') as f:
+        header = f.read(6)
+    compression = None
+    for magic, codec in PKL_MAGIC.items():
+        if header.startswith(magic):
+            compression = codec
+            break
+    return pd.read_pickle(data_file, compression=compression)
+
+
+# Supported compression codecs and argument of compression level for pickles
+COMPRESSION = {
+    'pkl': {'gzip': 'compresslevel', 'bz2': 'compresslevel', 'xz': 'preset', 'zstd': 'level'},
+    'parq': ['snappy', 'gzip', 'brotli', 'lz4', 'zstd'],
+    'arrow': ['lz4', 'zstd'],
+    'feather': ['lz4', 'zstd'],
+}
+
+
+def compression_kwargs(ext: str, compression=None, compression_level=None) -> dict:
+    """
+    Keyword arguments of saving functions for compression codec and level
+
+    Args:
+        ext: file extension
+        compression: codec, e.g., zstd, lz4, snappy, gzip
+        compression_level: compression level - codec default if None
+
+    Returns:
+        dict
+
+    Examples:
+        >>> compression_kwargs('pkl', 'zstd', 3)
+        {'compression': {'method': 'zstd', 'level': 3}}
+        >>> compression_kwargs('parq', 'snappy')
+        {'compression': 'snappy'}
+        >>> compression_kwargs('arrow', 'lz4', 9)
+        {'compression': 'lz4', 'compression_level': 9}
+        >>> compression_kwargs('csv')
+        {}
+        >>> compression_kwargs('pkl', 'snappy')
+        Traceback (most recent call last):
+        ValueError: compression snappy is not supported for .pkl files - use one of: gzip, bz2, xz, zstd
+    """
+    if not compression: return {}
+    if compression not in COMPRESSION.get(ext, []):
+        supported = ', '.join(COMPRESSION.get(ext, [])) or 'none'
+        raise ValueError(
+            f'compression {compression} is not supported for .{ext} files - use one of: {supported}'
+        )
+    if ext == 'pkl':
+        method = {'method': compression}
+        if compression_level is not None:
+            method[COMPRESSION[ext][compression]] = compression_level
+        return {'compression': method}
+    res = {'compression': compression}
+    if compression_level is not None: res['compression_level'] = compression_level
+    return res
+
 
 LOAD_FUNC = {
-    'pkl': pd.read_pickle,
+    'pkl': read_pickle,
     'parq': pd.read_parquet,
     'csv': pd.read_csv,
     'xls': pd.read_excel,
     'xlsx': pd.read_excel,
+    'arrow': read_arrow,
+    'feather': read_arrow,
 }
 
 SAVE_FUNC = {
@@ -20,8 +170,194 @@ SAVE_FUNC = {
     'csv': 'to_csv',
     'xlsx': 'to_excel',
     'xls': 'to_excel',
+    'arrow': to_arrow,
+    'feather': to_arrow,
+}
+
+# Index of dated cache files - saved under the data root path
+INDEX_FILE = '.cache_index.db'
+INDEX_TABLE = 'cache_index'
+_INDEX_READY_ = set()
+
+# Functions with retention policy of cached files
+_RETENTION_ = []
+
+# Background refreshes of stale data
+REFRESH_WORKERS = 4
+_REFRESH_ = dict()
+_REFRESH_POOL_ = [None]
+_REFRESH_LOCK_ = threading.Lock()
+
+# Parallel loading / saving of batched calls
+BATCH_WORKERS = 8
+
+# Row filters in the same format as pyarrow: (column, op, value)
+FILTER_OPS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda vals, v: vals.isin(v),
+    'not in': lambda vals, v: ~vals.isin(v),
 }
 
+# Sentinel for cache misses - cached data can be anything including None
+MISSING = object()
+
+
+class MemCache(object):
+    """
+    In-process LRU cache for loaded data, keyed by file name
+
+    Entries are bounded by number of items and approximate size in bytes,
+    and are invalidated once modified time of the underlying file changes
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> mem = MemCache(max_items=2)
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     data_file = f'{tmp}/sample.pkl'
+        ...     pd.DataFrame([{'a': 1}]).to_pickle(data_file)
+        ...     mem.get(data_file) is MISSING
+        ...     mtime = _mtime_(data_file)
+        ...     mem.put(data_file, data=pd.read_pickle(data_file), mtime=mtime)
+        ...     mem.get(data_file)
+        True
+           a
+        0  1
+        >>> stats = mem.stats()
+        >>> stats['hits'], stats['misses'], stats['items']
+        (1, 1, 1)
+        >>> mem.get('notfound.pkl') is MISSING
+        True
+
+        Data loaded before the file was rewritten is not served
+
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     data_file = f'{tmp}/sample.pkl'
+        ...     pd.DataFrame([{'a': 1}]).to_pickle(data_file)
+        ...     mtime = _mtime_(data_file)
+        ...     data = pd.read_pickle(data_file)
+        ...     pd.DataFrame([{'a': 2}]).to_pickle(data_file)
+        ...     os.utime(data_file, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+        ...     mem.put(data_file, data=data, mtime=mtime)
+        ...     mem.get(data_file) is MISSING
+        True
+    """
+
+    def __init__(self, max_items=128, max_bytes=2 ** 30):
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._data_ = OrderedDict()
+        self._bytes_ = 0
+        self._lock_ = threading.RLock()
+
+    def get(self, data_file: str):
+        """
+        Cached data if file is unchanged since it was cached, otherwise MISSING
+        """
+        mtime = _mtime_(data_file)
+        with self._lock_:
+            entry = self._data_.get(data_file, None)
+            if (entry is None) or (entry[0] != mtime):
+                if entry is not None: self.pop(data_file)
+                self.misses += 1
+                return MISSING
+            self._data_.move_to_end(data_file)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, data_file: str, data, mtime=MISSING):
+        """
+        Keep data in memory - skipped if file does not exist or data is too large
+
+        Modified time should be read before data is loaded, otherwise data
+        loaded before the file was rewritten would be kept as up to date
+        """
+        if mtime is MISSING: mtime = _mtime_(data_file)
+        if mtime is None: return
+        size = _nbytes_(data)
+        with self._lock_:
+            self.pop(data_file)
+            if size > self.max_bytes: return
+            self._data_[data_file] = (mtime, size, data)
+            self._bytes_ += size
+            while (
+                (len(self._data_) > self.max_items)
+                or (self._bytes_ > self.max_bytes)
+            ):
+                self._bytes_ -= self._data_.popitem(last=False)[1][1]
+
+    def pop(self, data_file: str):
+        """
+        Remove data from memory
+        """
+        with self._lock_:
+            entry = self._data_.pop(data_file, None)
+            if entry is not None: self._bytes_ -= entry[1]
+
+    def clear(self):
+        """
+        Remove all data and reset counters
+        """
+        with self._lock_:
+            self._data_.clear()
+            self._bytes_ = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        Hit / miss counters and current usage
+        """
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            items=len(self._data_),
+            bytes=self._bytes_,
+        )
+
+
+MEM_CACHE = MemCache()
+
+
+def _mtime_(data_file: str):
+    """
+    Last modified time of file in ns - None if file does not exist
+    """
+    try:
+        return os.stat(data_file).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _nbytes_(data) -> int:
+    """
+    Approximate size of data in memory
+    Objects in pandas data, e.g., strings, are counted as well - size of other data is
+    shallow, i.e., items of containers are not counted
+
+    Examples:
+        >>> _nbytes_(pd.DataFrame({'a': range(20)})) - _nbytes_(pd.DataFrame({'a': range(10)}))
+        80
+        >>> _nbytes_(pd.Series(range(10), dtype=float)) - _nbytes_(pd.Series(range(5), dtype=float))
+        40
+        >>> _nbytes_(pd.DataFrame({'a': ['x' * 1000] * 100})) > 100000
+        True
+    """
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True, deep=True).sum())
+    if isinstance(data, pd.Series):
+        return int(data.memory_usage(index=True, deep=True))
+    return sys.getsizeof(data)
+
 
 def with_cache(*dec_args, **dec_kwargs):
     """
@@ -36,6 +372,144 @@ def with_cache(*dec_args, **dec_kwargs):
         save_func: custom function to save data (has to use `data` and `date_file` as argument)
         file_func: custom function to generate file format:
                    data will be saved to f'{root_path}/{file_func(**kwargs)}'
+        mem_cache: keep loaded data in memory (see MEM_CACHE) - default False
+                   data returned from memory is shared across calls and should not be modified
+        cache_index: keep index of dated files in f'{root_path}/{INDEX_FILE}' - default False
+                     latest file within update_freq is found with one lookup instead of
+                     checking existence of files day by day
+        stale_freq: stale frequency, e.g., 1W, 1M, etc. - must be longer than update_freq
+                    if data is not updated within update_freq but was within stale_freq,
+                    stale data is returned immediately and refreshed in background
+                    (use `wait_refresh` to wait for pending refreshes, e.g., at shutdown)
+        lock: lock data file while retrieving data - default False
+              only one process retrieves missing data, others wait and read it from cache
+        compression: compression codec of pkl, parq, arrow or feather files, e.g., zstd, lz4, snappy, gzip
+                     pkl supports gzip, bz2, xz and zstd (requires zstandard)
+        compression_level: compression level - codec default if None
+        keep_dates: retention - number of latest dates to keep (see `gc`)
+        max_age: retention - max age of dated files, e.g., 3M, 1Y, etc.
+        max_bytes: retention - max total size of dated files, older files are removed first
+        hash_args: key cached files by hash of arguments - default False
+                   True for all arguments or list of argument names to hash, e.g., for
+                   DataFrames, long lists or objects without stable str / repr;
+                   fixed-length key is available as `{_key_}` in file_fmt (required), with default
+                   file_fmt f'{func.__name__}/{_key_}/[date].pkl', and original arguments
+                   are kept next to data files (see `args_file_name`)
+        append_kw: argument name of function to take the last cached index - default None
+                   if given, each dated file only keeps data appended on that date:
+                   function is called with the last index of all cached data and only
+                   data after it is saved, and data of all dates is returned together
+
+    Hits, misses, bytes read / written and latencies of each function are recorded in
+    `xone.metrics` registry under its scope name, e.g., `xone.metrics.to_prometheus('xone_cache')`
+
+    Coroutine functions are wrapped as coroutine functions: cache files are checked, loaded
+    and saved in thread executor, and concurrent calls of the same data share one pending call
+
+    Decorated function also takes these arguments:
+        _reload_: retrieve data and override cache
+        _columns_: list of columns to return
+        _filters_: row filters in pyarrow format, e.g., [('ticker', 'in', ['ES1', 'NQ1'])]
+                   columns and filters are pushed down to pyarrow for parquet files
+
+    Decorated function (not coroutine function) has `batch` for many calls at once:
+        func.batch(arg_sets, batch_func=None, workers=BATCH_WORKERS)
+        arg_sets: list of calls - dict of keyword arguments, tuple of positional
+                  arguments, or the first argument only
+        batch_func: function to retrieve all missing calls at once, taking list of
+                    keyword arguments of missing calls and returning list of data
+        existing files are found with one listing per folder, and loaded / saved in
+        parallel, results are returned in the same order as arg_sets
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> @with_cache(data_path=tmp.name, file_fmt='px/{ticker}/[date].pkl')
+        ... def px(ticker, fld='close'):
+        ...     return pd.DataFrame({'ticker': [ticker], 'fld': [fld]})
+        >>> _ = px('ES1')
+        >>> res = px.batch(
+        ...     ['NQ1', ('ES1',), {'ticker': 'VG1', 'fld': 'open'}],
+        ...     batch_func=lambda calls: [px.__wrapped__(**kw) for kw in calls],
+        ... )
+        >>> [r.values.tolist() for r in res]
+        [[['NQ1', 'close']], [['ES1', 'close']], [['VG1', 'open']]]
+
+        Arguments keyed by hash - control arguments are not part of key
+
+        >>> @with_cache(data_path=tmp.name, hash_args=True)
+        ... def basket(tickers, **kwargs):
+        ...     return pd.DataFrame({'n': [len(tickers)], 'dt': ['today']})
+        >>> tickers = [f'T{i}' for i in range(1000)]
+        >>> basket(tickers)['n'].tolist(), basket(tickers, _columns_=['n']).columns.tolist()
+        ([1000], ['n'])
+        >>> _ = basket(tickers, _reload_=True)
+        >>> len(os.listdir(f'{tmp.name}/basket'))
+        1
+        >>> with_cache(data_path=tmp.name, file_fmt='bk/[date].pkl', hash_args=True)(basket)
+        Traceback (most recent call last):
+        ...
+        ValueError: file_fmt of hashed arguments must have {_key_}: bk/[date].pkl
+
+        Stale data is returned at once and refreshed in background
+
+        >>> yesterday = (
+        ...     pd.Timestamp(utils.cur_time(trading=False)) - pd.Timedelta('1D')
+        ... ).strftime('%Y-%m-%d')
+        >>> @with_cache(data_path=tmp.name, file_fmt='fx/{ccy}/[date].pkl', stale_freq='1W')
+        ... def fx(ccy):
+        ...     return pd.DataFrame({'ccy': [ccy], 'src': ['live']})
+        >>> save_file(pd.DataFrame({'ccy': ['JPY'], 'src': ['old']}), f'{tmp.name}/fx/JPY/{yesterday}.pkl')
+        >>> fx('JPY')['src'].tolist()
+        ['old']
+        >>> wait_refresh(timeout=10)
+        0
+        >>> fx('JPY')['src'].tolist()
+        ['live']
+
+        Incremental mode - only data after last cached index is retrieved and saved
+
+        >>> calls = []
+        >>> @with_cache(data_path=tmp.name, file_fmt='ticks/[date].pkl', append_kw='start')
+        ... def ticks(start=None):
+        ...     calls.append(start)
+        ...     return pd.DataFrame({'px': range(5)})
+        >>> save_file(pd.DataFrame({'px': range(3)}), f'{tmp.name}/ticks/{yesterday}.pkl')
+        >>> ticks().index.tolist(), calls
+        ([0, 1, 2, 3, 4], [2])
+        >>> load_file(f'{tmp.name}/ticks/{utils.cur_time(trading=False)}.pkl').index.tolist()
+        [3, 4]
+
+        Only one caller retrieves missing data with lock - others read it from cache
+
+        >>> calls = []
+        >>> @with_cache(data_path=tmp.name, file_fmt='vol/{ticker}.pkl', lock=True)
+        ... def vol(ticker):
+        ...     calls.append(ticker)
+        ...     time.sleep(.2)
+        ...     return pd.DataFrame({'ticker': [ticker]})
+        >>> with ThreadPoolExecutor(max_workers=3) as pool:
+        ...     res = list(pool.map(vol, ['ES1'] * 3))
+        >>> [r['ticker'].tolist() for r in res], calls
+        ([['ES1'], ['ES1'], ['ES1']], ['ES1'])
+
+        Concurrent calls of coroutine functions share one pending call
+
+        >>> calls = []
+        >>> @with_cache(data_path=tmp.name, file_fmt='quote/{ticker}.pkl')
+        ... async def quote(ticker):
+        ...     calls.append(ticker)
+        ...     await asyncio.sleep(.1)
+        ...     return pd.DataFrame({'ticker': [ticker]})
+        >>> async def quotes():
+        ...     return await asyncio.gather(*[quote('NQ1') for _ in range(3)])
+        >>> loop = asyncio.new_event_loop()
+        >>> res = loop.run_until_complete(quotes())
+        >>> loop.close()
+        >>> [r['ticker'].tolist() for r in res], calls
+        ([['NQ1'], ['NQ1'], ['NQ1']], ['NQ1'])
+        >>> tmp.cleanup()
     """
     # Data root path
     data_root = dec_kwargs.get('data_path', None)
@@ -43,26 +517,92 @@ def with_cache(*dec_args, **dec_kwargs):
     file_fmt = dec_kwargs.get('file_fmt', None)
     # Update frequency - in pd.Timedelta - determines how frequent data should be updated
     update_freq = dec_kwargs.get('update_freq', None)
+    # Stale frequency - stale data is returned while being refreshed in background
+    stale_freq = dec_kwargs.get('stale_freq', None)
 
     # Data loading / saving functions
     # For saving, function has to have `data` and `data_file` as argument
     load_func = dec_kwargs.get('load_func', None)
     save_func = dec_kwargs.get('save_func', None)
     file_func = dec_kwargs.get('file_func', None)
+    # In-memory cache in front of disk lookups
+    mem_cache = dec_kwargs.get('mem_cache', False)
+    # Index of dated files for update frequency lookups
+    cache_index = dec_kwargs.get('cache_index', False)
+    # Lock data file across processes while retrieving data
+    lock = dec_kwargs.get('lock', False)
+    # Incremental mode - argument of function to take the last cached index
+    append_kw = dec_kwargs.get('append_kw', None)
+    # Retention policy of dated files - applied in `gc`
+    retention = {
+        k: dec_kwargs[k] for k in ['keep_dates', 'max_age', 'max_bytes']
+        if dec_kwargs.get(k, None) is not None
+    }
+    # Arguments keyed by content hash
+    hash_args = dec_kwargs.get('hash_args', False)
+    if isinstance(hash_args, str): hash_args = [hash_args]
+    # Compression codec and level
+    compression = dec_kwargs.get('compression', None)
+    compression_level = dec_kwargs.get('compression_level', None)
+    if compression and (not callable(save_func)) and (not callable(file_func)):
+        compression_kwargs(
+            ext=(file_fmt or 'pkl').split('.')[-1],
+            compression=compression, compression_level=compression_level,
+        )
 
     def decorator(func):
 
-        @wraps(func)
-        def wrapper(*args, **kwargs):
+        # Parameter layout is resolved once for all calls
+        bind_kwargs = func_binder(func)
+        # Cache hits / misses, bytes read / written and latencies
+        stats = metrics.get_metrics(utils.func_scope(func))
+        if hash_args:
+            default_fmt = f'{func.__name__}/{{_key_}}/[date].pkl'
+            if hash_args is not True:
+                params = inspect.signature(func).parameters
+                missing = [k for k in hash_args if k not in params]
+                if missing: raise ValueError(f'{missing} are not arguments of {func.__name__}')
+            if file_fmt and (not callable(file_func)) and ('{_key_}' not in file_fmt):
+                raise ValueError(f'file_fmt of hashed arguments must have {{_key_}}: {file_fmt}')
+        else:
+            default_fmt = f'{func.__name__}/[date].pkl'
+        if append_kw:
+            if append_kw not in inspect.signature(func).parameters:
+                raise ValueError(f'{append_kw} is not an argument of {func.__name__}')
+            if callable(file_func) or stale_freq or retention:
+                raise ValueError(
+                    'append_kw cannot be used with file_func, stale_freq or retention policy'
+                )
+        if retention:
+            if callable(file_func):
+                raise ValueError('retention policy cannot be used with file_func')
+            _RETENTION_.append(utils.AttributeDict(
+                func=func,
+                data_root=data_root,
+                file_fmt=file_fmt or default_fmt,
+                cache_index=cache_index,
+                **retention,
+            ))
 
+        def resolve(args: tuple, kwargs: dict) -> utils.AttributeDict:
+            """
+            Function arguments, data path and file name of current call
+            """
             # Check function parameters
-            param = inspect.signature(func).parameters
-            all_kw = {
-                k: args[n] if n < len(args) else v.default
-                for n, (k, v) in enumerate(param.items())
-            }
-            all_kw.update(utils.func_kwarg(func=func, **kwargs))
-            kwargs.update(all_kw)
+            all_kw = bind_kwargs(args, kwargs)
+            kwargs = {**kwargs, **all_kw}
+
+            # Content hash of arguments
+            hashed, fmt_kw = None, all_kw
+            if hash_args:
+                # Control arguments, e.g., _reload_ and _columns_, are not part of key
+                hashed = {
+                    k: v for k, v in all_kw.items()
+                    if (k in hash_args if hash_args is not True else k != append_kw)
+                    and not (k.startswith('_') and k.endswith('_'))
+                }
+                kwargs['_key_'] = hash_key(hashed)
+                fmt_kw = {**all_kw, '_key_': kwargs['_key_']}
 
             # Data path and file name
             cur_dt = utils.cur_time(
@@ -73,10 +613,7 @@ def with_cache(*dec_args, **dec_kwargs):
                 root_path = data_root
             else:
                 root_path = getattr(sys.modules[func.__module__], 'DATA_PATH')
-            if file_fmt:
-                file_name = target_file_name(fmt=file_fmt, **all_kw)
-            else:
-                file_name = f'{func.__name__}/[date].pkl'
+            file_name = target_file_name(fmt=file_fmt or default_fmt, **fmt_kw)
 
             if callable(file_func):
                 name_pattern = ''
@@ -88,33 +625,949 @@ def with_cache(*dec_args, **dec_kwargs):
                 )
                 data_file = name_pattern.replace('[date]', cur_dt)
 
-            # Reload data and override cache if necessary
-            use_cache = not kwargs.get('_reload_', False)
+            return utils.AttributeDict(
+                all_kw=all_kw,
+                kwargs=kwargs,
+                cur_dt=cur_dt,
+                root_path=root_path,
+                name_pattern=name_pattern,
+                data_file=data_file,
+                hashed=hashed,
+                # Reload data and override cache if necessary
+                use_cache=not kwargs.get('_reload_', False),
+            )
+
+        def lookup(ctx: utils.AttributeDict):
+            """
+            Cached data of current call - MISSING if not available
+            """
+            if mem_cache and (not ctx.use_cache): MEM_CACHE.pop(ctx.data_file)
+            if not ctx.use_cache: return MISSING
 
             # Load data if exists
-            if files.exists(data_file) and use_cache:
-                return load_file(data_file=data_file, load_func=load_func, **kwargs)
+            data = _load_(
+                data_file=ctx.data_file, load_func=load_func,
+                mem_cache=mem_cache, stats=stats, kwargs=ctx.kwargs,
+            )
 
             # Load data if it was updated within update frequency
-            if update_freq and use_cache and ('[date]' in name_pattern):
-                start_dt = pd.date_range(end=cur_dt, freq=update_freq, periods=2)[0]
-                for dt in pd.date_range(start=start_dt, end=cur_dt, normalize=True)[1:][::-1]:
-                    cur_file = name_pattern.replace('[date]', dt.strftime('%Y-%m-%d'))
-                    if files.exists(cur_file):
-                        return load_file(data_file=cur_file, load_func=load_func, **kwargs)
+            if (data is MISSING) and update_freq:
+                data = recent(ctx, all_dts=window_dates(ctx.cur_dt, update_freq))
+
+            if data is not MISSING: stats.inc('hits')
+            return data
+
+        def recent(ctx: utils.AttributeDict, all_dts: list):
+            """
+            Latest cached data of given dates (in descending order) - MISSING if not available
+            """
+            if (not all_dts) or ('[date]' not in ctx.name_pattern): return MISSING
 
-            # Retrieve data
-            data = func(**all_kw)
+            idx_kw = dict(root_path=ctx.root_path, name_pattern=ctx.name_pattern)
+            if cache_index:
+                idx_dt = index_latest(start_dt=all_dts[-1], end_dt=all_dts[0], **idx_kw)
+                if idx_dt:
+                    data = _load_(
+                        data_file=ctx.name_pattern.replace('[date]', idx_dt),
+                        load_func=load_func, mem_cache=mem_cache, stats=stats, kwargs=ctx.kwargs,
+                    )
+                    if data is not MISSING: return data
+                    index_remove(dt=idx_dt, **idx_kw)
+            for dt in all_dts:
+                data = _load_(
+                    data_file=ctx.name_pattern.replace('[date]', dt),
+                    load_func=load_func, mem_cache=mem_cache, stats=stats, kwargs=ctx.kwargs,
+                )
+                if data is MISSING: continue
+                if cache_index: index_update(dt=dt, **idx_kw)
+                return data
+
+            return MISSING
+
+        def stale(ctx: utils.AttributeDict):
+            """
+            Cached data older than update frequency but within stale frequency
+            MISSING if not available
+            """
+            if (not stale_freq) or (not ctx.use_cache): return MISSING
 
-            # Save data to cache
-            save_file(data=data, data_file=data_file, save_func=save_func, **kwargs)
+            if update_freq: fresh_dts = set(window_dates(ctx.cur_dt, update_freq))
+            else: fresh_dts = {ctx.cur_dt}
+            data = recent(ctx, all_dts=[
+                dt for dt in window_dates(ctx.cur_dt, stale_freq) if dt not in fresh_dts
+            ])
+            if data is not MISSING: stats.inc('stale_hits')
+            return data
 
+        def reload(ctx: utils.AttributeDict):
+            """
+            Cached data saved by other processes while waiting for lock
+            """
+            if (not ctx.use_cache) or append_kw: return MISSING
+            data = _load_(
+                data_file=ctx.data_file, load_func=load_func,
+                mem_cache=mem_cache, stats=stats, kwargs=ctx.kwargs,
+            )
+            if data is not MISSING: stats.inc('hits')
             return data
+
+        def update(ctx: utils.AttributeDict):
+            """
+            Retrieve data and save to cache
+            """
+            if not lock: return retrieve(ctx)
+
+            # Only one process retrieves data - others wait and read from cache
+            with files.FileLock(lock_file_name(ctx.data_file)):
+                data = reload(ctx)
+                if data is not MISSING: return data
+                return retrieve(ctx)
+
+        def retrieve(ctx: utils.AttributeDict):
+
+            if append_kw:
+                job = append_load(ctx)
+                if job.data is not MISSING: return job.data
+                return append_save(ctx, job=job, data=compute(job.call_kw))
+
+            # Retrieve data and save to cache
+            return save(ctx, data=compute(ctx.all_kw))
+
+        def compute(call_kw: dict):
+
+            stats.inc('misses')
+            start = time.perf_counter()
+            try:
+                return func(**call_kw)
+            finally:
+                stats.observe('compute_seconds', time.perf_counter() - start)
+
+        def save(ctx: utils.AttributeDict, data):
+            """
+            Save data to cache and return selected data
+            """
+            store(ctx, data=data)
+            return select_data(
+                data=data,
+                columns=ctx.kwargs.get('_columns_', None),
+                filters=ctx.kwargs.get('_filters_', None),
+            )
+
+        def store(ctx: utils.AttributeDict, data):
+            """
+            Save data to cache
+            """
+            start = time.perf_counter()
+            save_file(
+                data=data, data_file=ctx.data_file, save_func=save_func,
+                compression=compression, compression_level=compression_level, **ctx.kwargs
+            )
+            size = _fsize_(ctx.data_file)
+            if size:
+                stats.observe('save_seconds', time.perf_counter() - start)
+                stats.inc('bytes_written', size)
+            if mem_cache: MEM_CACHE.put(ctx.data_file, data=data)
+            if (ctx.hashed is not None) and size:
+                save_args(ctx.hashed, args_file=args_file_name(ctx.data_file, key=ctx.kwargs['_key_']))
+            if cache_index and ('[date]' in ctx.name_pattern) and files.exists(ctx.data_file):
+                index_update(
+                    root_path=ctx.root_path, name_pattern=ctx.name_pattern, dt=ctx.cur_dt
+                )
+
+        def append_load(ctx: utils.AttributeDict) -> utils.AttributeDict:
+            """
+            Cached partitions of incremental mode and arguments to retrieve missing tail
+            data is cached data if it is up to date, otherwise MISSING
+            """
+            load_kw = {k: v for k, v in ctx.kwargs.items() if k not in ['_columns_', '_filters_']}
+            parts = dated_files(name_pattern=ctx.name_pattern, end_dt=ctx.cur_dt)
+            hist = None
+            if ctx.use_cache and parts:
+                hist = pd.concat([
+                    _load_(
+                        data_file=part, load_func=load_func,
+                        mem_cache=mem_cache, stats=stats, kwargs=load_kw,
+                    )
+                    for part in parts.values()
+                ], sort=False)
+                if update_freq: fresh_dts = window_dates(ctx.cur_dt, update_freq)
+                else: fresh_dts = [ctx.cur_dt]
+                if list(parts)[-1] in fresh_dts:
+                    stats.inc('hits')
+                    return utils.AttributeDict(data=select_data(
+                        data=hist,
+                        columns=ctx.kwargs.get('_columns_', None),
+                        filters=ctx.kwargs.get('_filters_', None),
+                    ))
+
+            # Full history if nothing is cached yet, otherwise missing tail only
+            if (hist is None) or hist.empty:
+                return utils.AttributeDict(
+                    data=MISSING, hist=None, parts=parts, call_kw=ctx.all_kw,
+                )
+            last_idx = hist.index.max()
+            return utils.AttributeDict(
+                data=MISSING, hist=hist, parts=parts, last_idx=last_idx,
+                call_kw={**ctx.all_kw, append_kw: last_idx},
+            )
+
+        def append_save(ctx: utils.AttributeDict, job: utils.AttributeDict, data):
+            """
+            Save retrieved data of incremental mode as partition of current date
+            """
+            if job.hist is None:
+                store(ctx, data=data)
+                if not ctx.use_cache:
+                    # Older partitions are replaced by full history
+                    for dt, part in job.parts.items():
+                        if dt == ctx.cur_dt: continue
+                        os.remove(part)
+                        if mem_cache: MEM_CACHE.pop(part)
+                        if cache_index:
+                            index_remove(root_path=ctx.root_path, name_pattern=ctx.name_pattern, dt=dt)
+                hist = data
+            else:
+                hist = job.hist
+                if isinstance(data, (pd.Series, pd.DataFrame)) and (not data.empty):
+                    delta = data.loc[data.index > job.last_idx]
+                    store(ctx, data=delta)
+                    hist = pd.concat([hist, delta], sort=False)
+            return select_data(
+                data=hist,
+                columns=ctx.kwargs.get('_columns_', None),
+                filters=ctx.kwargs.get('_filters_', None),
+            )
+
+        if inspect.iscoroutinefunction(func):
+            return _async_wrapper_(
+                func=func,
+                resolve=resolve,
+                lookup=lookup,
+                stale=stale,
+                reload=reload,
+                save=save,
+                append_load=append_load if append_kw else None,
+                append_save=append_save,
+                lock=lock,
+                stats=stats,
+            )
+
+        def batch(arg_sets, batch_func=None, workers=BATCH_WORKERS) -> list:
+            """
+            Cached data of many calls - see `with_cache`
+            """
+            ctxs = [resolve(*_call_args_(arg_set)) for arg_set in arg_sets]
+            if append_kw: return [update(ctx) for ctx in ctxs]
+
+            # Existing files of all calls with one listing per folder
+            listed, windows = dict(), dict()
+
+            def exists(data_file: str) -> bool:
+                path, name = os.path.split(data_file)
+                if path not in listed:
+                    try:
+                        listed[path] = set(os.listdir(path or '.'))
+                    except OSError:
+                        listed[path] = set()
+                return name in listed[path]
+
+            def dates(cur_dt: str) -> list:
+                # Fresh and stale dates of current date
+                if cur_dt not in windows:
+                    fresh = window_dates(cur_dt, update_freq) if update_freq else [cur_dt]
+                    windows[cur_dt] = [(dt, False) for dt in fresh] + [
+                        (dt, True) for dt in (window_dates(cur_dt, stale_freq) if stale_freq else [])
+                        if dt not in fresh
+                    ]
+                return windows[cur_dt]
+
+            found, misses = dict(), []
+            for n, ctx in enumerate(ctxs):
+                if mem_cache and (not ctx.use_cache): MEM_CACHE.pop(ctx.data_file)
+                if ctx.use_cache:
+                    if exists(ctx.data_file):
+                        found[n] = (ctx.data_file, False)
+                        continue
+                    if '[date]' in ctx.name_pattern:
+                        for dt, is_stale in dates(ctx.cur_dt):
+                            data_file = ctx.name_pattern.replace('[date]', dt)
+                            if exists(data_file):
+                                found[n] = (data_file, is_stale)
+                                break
+                        if n in found: continue
+                misses.append(n)
+
+            res = [MISSING] * len(ctxs)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                loaded = _pool_map_(pool, lambda n: _load_(
+                    data_file=found[n][0], load_func=load_func,
+                    mem_cache=mem_cache, stats=stats, kwargs=ctxs[n].kwargs,
+                ), list(found), workers=workers)
+                for n, data in zip(list(found), loaded):
+                    if data is MISSING:
+                        misses.append(n)
+                        continue
+                    res[n] = data
+                    if found[n][1]:
+                        stats.inc('stale_hits')
+                        refresh(update, ctxs[n])
+                    else:
+                        stats.inc('hits')
+
+                misses.sort()
+                if callable(batch_func) and misses:
+                    stats.inc('misses', len(misses))
+                    start = time.perf_counter()
+                    retrieved = list(batch_func([ctxs[n].all_kw for n in misses]))
+                    stats.observe('compute_seconds', time.perf_counter() - start)
+                    if len(retrieved) != len(misses):
+                        raise ValueError(
+                            f'batch_func returned {len(retrieved)} results for {len(misses)} calls'
+                        )
+                    saved = _pool_map_(
+                        pool, lambda job: save(ctxs[job[0]], data=job[1]),
+                        list(zip(misses, retrieved)), workers=workers,
+                    )
+                    for n, data in zip(misses, saved): res[n] = data
+                else:
+                    for n in misses: res[n] = update(ctxs[n])
+
+            return res
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+
+            ctx = resolve(args, kwargs)
+            if append_kw: return update(ctx)
+            data = lookup(ctx)
+            if data is not MISSING: return data
+            data = stale(ctx)
+            if data is not MISSING:
+                refresh(update, ctx)
+                return data
+            return update(ctx)
+
+        wrapper.batch = batch
         return wrapper
 
     return decorator(dec_args[0]) if dec_args and callable(dec_args[0]) else decorator
 
 
+def _call_args_(arg_set) -> tuple:
+    """
+    Positional and keyword arguments of one call in batch
+
+    Examples:
+        >>> _call_args_({'ticker': 'ES1'}), _call_args_(('ES1', 'open')), _call_args_('ES1')
+        (((), {'ticker': 'ES1'}), (('ES1', 'open'), {}), (('ES1',), {}))
+    """
+    if isinstance(arg_set, dict): return (), arg_set
+    if isinstance(arg_set, tuple): return arg_set, {}
+    return (arg_set,), {}
+
+
+def _pool_map_(pool, fn, items: list, workers: int) -> list:
+    """
+    Map function over items with one task per chunk of items instead of per item
+
+    Examples:
+        >>> with ThreadPoolExecutor(max_workers=2) as pool:
+        ...     _pool_map_(pool, lambda x: x * 2, list(range(5)), workers=2)
+        [0, 2, 4, 6, 8]
+    """
+    if not items: return []
+    size = -(-len(items) // max(workers, 1))
+    chunks = pool.map(lambda chunk: [fn(item) for item in chunk], [
+        items[i:i + size] for i in range(0, len(items), size)
+    ])
+    return [res for chunk in chunks for res in chunk]
+
+
+def _async_wrapper_(
+        func, resolve, lookup, stale, reload, save, append_load, append_save, lock, stats,
+):
+    """
+    Cache wrapper of coroutine function
+
+    Checking and loading cache files, as well as saving data, run in thread executor
+    without blocking event loop, while data is retrieved by awaiting func in event loop.
+    Concurrent calls of the same data are served by one pending task.
+    """
+    in_flight = dict()
+
+    async def retrieve(ctx, run):
+
+        if append_load is not None:
+            job = await run(append_load, ctx)
+            if job.data is not MISSING: return job.data
+            data = await compute(job.call_kw)
+            return await run(append_save, ctx, job, data)
+
+        return await run(save, ctx, await compute(ctx.all_kw))
+
+    async def compute(call_kw: dict):
+
+        stats.inc('misses')
+        start = time.perf_counter()
+        try:
+            return await func(**call_kw)
+        finally:
+            stats.observe('compute_seconds', time.perf_counter() - start)
+
+    async def update(ctx):
+
+        loop = asyncio.get_event_loop()
+
+        def run(*args):
+            return loop.run_in_executor(None, *args)
+
+        if not lock: return await retrieve(ctx, run=run)
+
+        # Only one process retrieves data - others wait and read from cache
+        file_lock = files.FileLock(lock_file_name(ctx.data_file))
+        await run(file_lock.acquire)
+        try:
+            data = await run(reload, ctx)
+            if data is not MISSING: return data
+            return await retrieve(ctx, run=run)
+        finally:
+            file_lock.release()
+
+    async def fetch(ctx):
+
+        loop = asyncio.get_event_loop()
+        if append_load is None:
+            data = await loop.run_in_executor(None, lookup, ctx)
+            if data is not MISSING: return data
+            data = await loop.run_in_executor(None, stale, ctx)
+            if data is not MISSING:
+                refresh(update, ctx)
+                return data
+        return await update(ctx)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+
+        ctx = resolve(args, kwargs)
+        key = (
+            asyncio.get_event_loop(),
+            ctx.data_file,
+            ctx.use_cache,
+            repr(ctx.kwargs.get('_columns_', None)),
+            repr(ctx.kwargs.get('_filters_', None)),
+        )
+        task = in_flight.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(fetch(ctx))
+            in_flight[key] = task
+            task.add_done_callback(lambda _: in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
+def window_dates(cur_dt: str, freq: str) -> list:
+    """
+    Dates within frequency window up to current date in descending order
+
+    Args:
+        cur_dt: current date
+        freq: frequency, e.g., 1W, 1M, etc.
+
+    Returns:
+        list
+
+    Examples:
+        >>> window_dates('2020-01-06', freq='3D')
+        ['2020-01-06', '2020-01-05', '2020-01-04']
+        >>> dts = window_dates('2020-06-15', freq='10D')
+        >>> len(dts), dts[-1]
+        (10, '2020-06-06')
+    """
+    start_dt = pd.date_range(end=cur_dt, freq=freq, periods=2)[0]
+    return [
+        dt.strftime('%Y-%m-%d') for dt in
+        pd.date_range(start=start_dt, end=cur_dt, normalize=True)[1:][::-1]
+    ]
+
+
+def dated_files(name_pattern: str, end_dt: str = None) -> dict:
+    """
+    All existing files of name pattern with one directory search
+
+    Args:
+        name_pattern: full name of file with `[date]` in it
+        end_dt: latest date (inclusive) to include
+
+    Returns:
+        dict: date -> file name, sorted by dates
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     for dt in ['2020-01-02', '2020-01-03', '2020-01-06']:
+        ...         files.create_folder(f'{tmp}/daily/{dt}.pkl', is_file=True)
+        ...         open(f'{tmp}/daily/{dt}.pkl', 'w').close()
+        ...     open(f'{tmp}/daily/2020-01.pkl', 'w').close()
+        ...     res = dated_files(f'{tmp}/daily/[date].pkl', end_dt='2020-01-05')
+        ...     list(res), res['2020-01-03'] == f'{tmp}/daily/2020-01-03.pkl'
+        (['2020-01-02', '2020-01-03'], True)
+    """
+    if '[date]' not in name_pattern: return dict()
+    name_pattern = name_pattern.replace('\\', '/')
+    fmt = '[0-9]' * 4 + '-' + '[0-9]' * 2 + '-' + '[0-9]' * 2
+    pos = name_pattern.index('[date]')
+    res = dict()
+    for f in glob.glob(glob.escape(name_pattern).replace(glob.escape('[date]'), fmt)):
+        f = f.replace('\\', '/')
+        dt = f[pos:pos + 10]
+        if end_dt and (dt > end_dt): continue
+        res[dt] = f
+    return dict(sorted(res.items()))
+
+
+def gc(func=None, dry_run=False) -> list:
+    """
+    Remove cached files according to retention policies of decorated functions
+    Each function is checked with one directory scan - dates are parsed from file names,
+    and file sizes are only checked if max_bytes is set
+
+    Args:
+        func: decorated function - all functions with retention policy if None
+        dry_run: list files to be removed without removing them
+
+    Lock files of removed data files are removed as well, and so are files of
+    original arguments of hashed keys once no data files of the key are left
+
+    Returns:
+        list: files removed
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> @with_cache(data_path=tmp.name, file_fmt='px/{ticker}/[date].pkl', keep_dates=2)
+        ... def px(ticker):
+        ...     return pd.DataFrame({'ticker': [ticker]})
+        >>> for dt in ['2020-01-02', '2020-01-03', '2020-01-06']:
+        ...     for tck in ['ES1', 'NQ1']:
+        ...         save_file(pd.DataFrame({'ticker': [tck]}), f'{tmp.name}/px/{tck}/{dt}.pkl')
+        >>> removed = gc(px, dry_run=True)
+        >>> [f[len(tmp.name):] for f in sorted(removed)]
+        ['/px/ES1/2020-01-02.pkl', '/px/NQ1/2020-01-02.pkl']
+        >>> [f[len(tmp.name):] for f in sorted(gc(px))] == [f[len(tmp.name):] for f in sorted(removed)]
+        True
+        >>> sorted(os.listdir(f'{tmp.name}/px/ES1'))[:2]
+        ['2020-01-03.pkl', '2020-01-06.pkl']
+        >>>
+        >>> @with_cache(data_path=tmp.name, hash_args=True, max_age='30D')
+        ... def basket(tickers):
+        ...     return pd.DataFrame({'ticker': tickers})
+        >>> key_path = f'{tmp.name}/basket/3c1e'
+        >>> for dt in ['2020-01-02', '2020-01-03']:
+        ...     save_file(pd.DataFrame({'ticker': ['ES1']}), f'{key_path}/{dt}.pkl')
+        ...     open(lock_file_name(f'{key_path}/{dt}.pkl'), 'w').close()
+        >>> save_args({'tickers': ['ES1', 'NQ1']}, args_file=f'{key_path}/.args-3c1e.pkl')
+        >>> sorted(os.listdir(key_path))[:2]
+        ['.args-3c1e.pkl', '2020-01-02.pkl']
+        >>> len(gc(basket)), os.listdir(key_path)
+        (2, [])
+        >>>
+        >>> @with_cache(data_path=tmp.name, file_fmt='eq/[date].pkl', max_age='1M')
+        ... def eq():
+        ...     return pd.DataFrame({'n': [1]})
+        >>> today = pd.Timestamp(utils.cur_time(trading=False))
+        >>> for days in [20, 40]:
+        ...     save_file(eq.__wrapped__(), f'{tmp.name}/eq/{today - pd.Timedelta(days, "D"):%Y-%m-%d}.pkl')
+        >>> [f[len(tmp.name):] for f in gc(eq, dry_run=True)] == [f'/eq/{today - pd.Timedelta(40, "D"):%Y-%m-%d}.pkl']
+        True
+        >>> tmp.cleanup()
+    """
+    logger = logs.get_logger(gc)
+    removed = []
+    for spec in _RETENTION_:
+        if (func is not None) and (getattr(func, '__wrapped__', func) is not spec.func): continue
+        root_path = spec.data_root or getattr(sys.modules[spec.func.__module__], 'DATA_PATH', '')
+        if not root_path: continue
+        name_pattern = (
+            f'{root_path}/{spec.file_fmt}'.replace('\\', '/').replace('[today]', '[date]')
+        )
+        if '[date]' not in name_pattern: continue
+
+        to_remove = _expired_(name_pattern=name_pattern, **{
+            k: spec.get(k, None) for k in ['keep_dates', 'max_age', 'max_bytes']
+        })
+        if dry_run:
+            removed += [f for f, _, _ in to_remove]
+            continue
+        for data_file, key, dt in to_remove:
+            try:
+                os.remove(data_file)
+            except OSError as e:
+                logger.warning(f'Cannot remove {data_file}: {e}')
+                continue
+            MEM_CACHE.pop(data_file)
+            if spec.cache_index: index_remove(root_path=root_path, name_pattern=key, dt=dt)
+            removed.append(data_file)
+            lock_file = lock_file_name(data_file)
+            if os.path.exists(lock_file):
+                try:
+                    os.remove(lock_file)
+                except OSError as e:
+                    logger.warning(f'Cannot remove {lock_file}: {e}')
+
+        for path in {os.path.split(data_file)[0] for data_file, _, _ in to_remove}:
+            _remove_args_(path)
+
+    return removed
+
+
+def _remove_args_(path: str):
+    """
+    Remove files of original arguments under path without data files of hashed keys
+    """
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    data_files = [
+        f'{path}/{name}' for name in names
+        if not (name.startswith('~') or name.startswith('.'))
+    ]
+    for name in names:
+        if not (name.startswith('.args-') and name.endswith('.pkl')): continue
+        key = name[len('.args-'):-len('.pkl')]
+        if any(key in data_file for data_file in data_files): continue
+        try:
+            os.remove(f'{path}/{name}')
+        except OSError:
+            pass
+
+
+def _expired_(name_pattern: str, keep_dates=None, max_age=None, max_bytes=None) -> list:
+    """
+    Dated files of name pattern beyond retention policy
+
+    Returns:
+        list: (file name, name pattern of file, date)
+    """
+    # Fixed folder in front of any variable part of file names
+    prefix = re.split(r'\{|\[date\]', name_pattern)[0]
+    base = prefix[:prefix.rfind('/')] if '/' in prefix else '.'
+    depth = name_pattern.count('/') - base.count('/')
+    regex = re.compile(''.join(
+        '(?P<date>\\d{4}-\\d{2}-\\d{2})' if part == '[date]'
+        else '[^/]*' if part.startswith('{')
+        else re.escape(part)
+        for part in re.split(r'(\{[^}]*\}|\[date\])', name_pattern) if part
+    ))
+
+    groups = dict()
+    for entry in _scan_(base, depth=depth):
+        data_file = entry.path.replace('\\', '/')
+        matched = regex.fullmatch(data_file)
+        if matched is None: continue
+        dt = matched.group('date')
+        key = data_file[:matched.start('date')] + '[date]' + data_file[matched.end('date'):]
+        size = entry.stat().st_size if max_bytes is not None else 0
+        groups.setdefault(key, []).append((dt, data_file, size))
+
+    expired, kept = [], []
+    cutoff = ''
+    if max_age is not None:
+        cutoff = age_cutoff(cur_dt=utils.cur_time(trading=False), max_age=max_age)
+    for key, dated in groups.items():
+        for n, (dt, data_file, size) in enumerate(sorted(dated, reverse=True)):
+            if ((keep_dates is not None) and (n >= keep_dates)) or (dt < cutoff):
+                expired.append((data_file, key, dt))
+            else:
+                kept.append((dt, data_file, key, size))
+
+    if max_bytes is not None:
+        total = sum(size for _, _, _, size in kept)
+        for dt, data_file, key, size in sorted(kept):
+            if total <= max_bytes: break
+            expired.append((data_file, key, dt))
+            total -= size
+
+    return expired
+
+
+def age_cutoff(cur_dt: str, max_age: str) -> str:
+    """
+    Earliest date within max age of current date
+    Months, quarters and years are calendar periods, not anchored to period ends
+
+    Args:
+        cur_dt: current date
+        max_age: max age, e.g., 10D, 2W, 3M, 1Q, 1Y, etc.
+
+    Returns:
+        str
+
+    Examples:
+        >>> age_cutoff('2026-10-17', max_age='1M')
+        '2026-09-17'
+        >>> age_cutoff('2026-10-17', max_age='1Y')
+        '2025-10-17'
+        >>> age_cutoff('2026-03-31', max_age='1Q')
+        '2025-12-31'
+        >>> age_cutoff('2026-10-17', max_age='10D')
+        '2026-10-07'
+    """
+    matched = re.fullmatch(r'(\d*)\s*([A-Za-z]+)', str(max_age).strip())
+    num, unit = matched.groups() if matched else ('', '')
+    num = int(num or 1)
+    unit = unit.upper()
+    if unit in ['Y', 'A', 'YS', 'AS']: offset = pd.DateOffset(years=num)
+    elif unit in ['Q', 'QS']: offset = pd.DateOffset(months=3 * num)
+    elif unit in ['M', 'MS']: offset = pd.DateOffset(months=num)
+    elif unit == 'W': offset = pd.DateOffset(weeks=num)
+    else: offset = pd.Timedelta(max_age)
+    return (pd.Timestamp(cur_dt) - offset).strftime('%Y-%m-%d')
+
+
+def _scan_(path: str, depth: int):
+    """
+    All files under path up to given depth with one pass of directory listings
+    """
+    if depth <= 0: return
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith('~') or entry.name.startswith('.'): continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan_(entry.path, depth=depth - 1)
+        elif depth == 1:
+            yield entry
+
+
+def refresh(update_func, ctx):
+    """
+    Refresh cache data in background - pending refresh of the same file is not repeated
+    Coroutine functions are scheduled in current event loop, others run in thread pool
+
+    Args:
+        update_func: function to retrieve and save data
+        ctx: context of function call, with data_file in it
+    """
+    with _REFRESH_LOCK_:
+        if ctx.data_file in _REFRESH_: return _REFRESH_[ctx.data_file]
+        if inspect.iscoroutinefunction(update_func):
+            future = futures.Future()
+            task = asyncio.ensure_future(update_func(ctx))
+            task.add_done_callback(lambda t: _copy_result_(t, future))
+        else:
+            if _REFRESH_POOL_[0] is None:
+                _REFRESH_POOL_[0] = ThreadPoolExecutor(
+                    max_workers=REFRESH_WORKERS, thread_name_prefix='xone-cache-refresh',
+                )
+            future = _REFRESH_POOL_[0].submit(update_func, ctx)
+        _REFRESH_[ctx.data_file] = future
+
+    def done(fut):
+        with _REFRESH_LOCK_:
+            _REFRESH_.pop(ctx.data_file, None)
+        if (not fut.cancelled()) and (fut.exception() is not None):
+            logger = logs.get_logger(refresh)
+            logger.error(f'Failed to refresh {ctx.data_file}: {fut.exception()}')
+
+    future.add_done_callback(done)
+    return future
+
+
+def _copy_result_(task, future: futures.Future):
+    """
+    Copy result of asyncio task to concurrent future
+    """
+    if task.cancelled(): future.cancel()
+    elif task.exception() is not None: future.set_exception(task.exception())
+    else: future.set_result(task.result())
+
+
+def wait_refresh(timeout=None) -> int:
+    """
+    Wait for pending background refreshes
+    Refreshes of coroutine functions need their event loop running - use `wait_refresh_async`
+
+    Args:
+        timeout: max seconds to wait - wait until all finished if None
+
+    Returns:
+        int: number of refreshes still pending
+    """
+    with _REFRESH_LOCK_:
+        pending = list(_REFRESH_.values())
+    return len(futures.wait(pending, timeout=timeout).not_done)
+
+
+async def wait_refresh_async(timeout=None) -> int:
+    """
+    Wait for pending background refreshes without blocking event loop
+
+    Args:
+        timeout: max seconds to wait - wait until all finished if None
+
+    Returns:
+        int: number of refreshes still pending
+    """
+    with _REFRESH_LOCK_:
+        pending = [asyncio.wrap_future(fut) for fut in _REFRESH_.values()]
+    if not pending: return 0
+    _, not_done = await asyncio.wait(pending, timeout=timeout)
+    return len(not_done)
+
+
+def _index_db_(root_path: str) -> xql.SQLite:
+    """
+    Database of cache index under root path - table is created if not exists
+    """
+    db_file = f'{root_path}/{INDEX_FILE}'.replace('\\', '/')
+    # Data roots can be on network shares, where WAL mode of SQLite is not supported
+    db = xql.SQLite(db_file, keep_live=True, journal_mode='DELETE')
+    if db_file not in _INDEX_READY_:
+        files.create_folder(db_file, is_file=True)
+        with db.con as con:
+            con.execute(
+                f'CREATE TABLE IF NOT EXISTS `{INDEX_TABLE}` '
+                f'(pattern TEXT, date TEXT, PRIMARY KEY (pattern, date))'
+            )
+        _INDEX_READY_.add(db_file)
+    return db
+
+
+def _index_key_(root_path: str, name_pattern: str) -> str:
+    """
+    Name pattern relative to root path
+
+    Examples:
+        >>> _index_key_('/data', '/data/daily/[date].pkl')
+        'daily/[date].pkl'
+        >>> _index_key_('/data/', '/data/ticker=ES1/[date].pkl')
+        'ticker=ES1/[date].pkl'
+    """
+    root = root_path.replace('\\', '/').rstrip('/') + '/'
+    if name_pattern.startswith(root): return name_pattern[len(root):]
+    return name_pattern
+
+
+def index_latest(root_path: str, name_pattern: str, start_dt: str, end_dt: str) -> str:
+    """
+    Latest date of indexed file within given date range
+
+    Args:
+        root_path: root data path
+        name_pattern: full name of file with `[date]` in it
+        start_dt: start date (inclusive) in format of %Y-%m-%d
+        end_dt: end date (inclusive) in format of %Y-%m-%d
+
+    Returns:
+        str: date of the file - empty if not found
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     pattern = f'{tmp}/daily/[date].pkl'
+        ...     index_update(root_path=tmp, name_pattern=pattern, dt='2020-01-02')
+        ...     index_update(root_path=tmp, name_pattern=pattern, dt='2020-01-06')
+        ...     index_latest(tmp, pattern, start_dt='2020-01-01', end_dt='2020-01-05')
+        ...     index_remove(root_path=tmp, name_pattern=pattern, dt='2020-01-02')
+        ...     index_latest(tmp, pattern, start_dt='2020-01-01', end_dt='2020-01-05')
+        ...     _index_db_(tmp).close()
+        '2020-01-02'
+        ''
+    """
+    logger = logs.get_logger(index_latest)
+    try:
+        res = _index_db_(root_path=root_path).con.execute(
+            f'SELECT max(date) FROM `{INDEX_TABLE}` '
+            f'WHERE pattern = ? AND date >= ? AND date <= ?',
+            (_index_key_(root_path, name_pattern), start_dt, end_dt),
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f'Cannot read cache index under {root_path}: {e}')
+        return ''
+    return res[0] or ''
+
+
+def index_update(root_path: str, name_pattern: str, dt: str):
+    """
+    Add dated file to cache index
+    """
+    _index_write_(
+        f'REPLACE INTO `{INDEX_TABLE}` (pattern, date) VALUES (?, ?)',
+        root_path=root_path, name_pattern=name_pattern, dt=dt,
+    )
+
+
+def index_remove(root_path: str, name_pattern: str, dt: str):
+    """
+    Remove dated file from cache index
+    """
+    _index_write_(
+        f'DELETE FROM `{INDEX_TABLE}` WHERE pattern = ? AND date = ?',
+        root_path=root_path, name_pattern=name_pattern, dt=dt,
+    )
+
+
+def _index_write_(query: str, root_path: str, name_pattern: str, dt: str):
+    """
+    Write to cache index - failures are logged as index is only for lookup speed
+    """
+    logger = logs.get_logger(_index_write_)
+    try:
+        with _index_db_(root_path=root_path).con as con:
+            con.execute(query, (_index_key_(root_path, name_pattern), dt))
+    except sqlite3.Error as e:
+        logger.warning(f'Cannot update cache index under {root_path}: {e}')
+
+
+def func_binder(func):
+    """
+    Precompiled binder of function arguments
+
+    Parameters of func are resolved once, and the returned function maps
+    positional and keyword arguments of each call to all keyword arguments
+    of func with defaults filled in
+
+    Args:
+        func: function
+
+    Returns:
+        function of (args, kwargs) -> dict
+
+    Examples:
+        >>> def sample(ticker, fld='px', *args, adj=False, **kwargs): pass
+        >>> bind_sample = func_binder(sample)
+        >>> bind_sample(('ES1 Index',), {'adj': True, 'end': '2020-12-31'})
+        {'ticker': 'ES1 Index', 'fld': 'px', 'adj': True, 'end': '2020-12-31'}
+        >>> def sample_2(ticker, fld='px'): pass
+        >>> func_binder(sample_2)(('ES1 Index', 'vol'), {'end': '2020-12-31'})
+        {'ticker': 'ES1 Index', 'fld': 'vol'}
+    """
+    var_kinds = (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD)
+    param = inspect.signature(func).parameters
+    defaults = {k: v.default for k, v in param.items() if v.kind not in var_kinds}
+    positional = [
+        k for k, v in param.items()
+        if v.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    ]
+    var_kw = any(v.kind == inspect.Parameter.VAR_KEYWORD for v in param.values())
+
+    def bind(args: tuple, kwargs: dict) -> dict:
+        all_kw = defaults.copy()
+        all_kw.update(zip(positional, args))
+        if var_kw: all_kw.update(kwargs)
+        else: all_kw.update((k, v) for k, v in kwargs.items() if k in defaults)
+        return all_kw
+
+    return bind
+
+
 def target_file_name(fmt: str, **kwargs) -> str:
     """
     Target file name
@@ -130,7 +1583,11 @@ def target_file_name(fmt: str, **kwargs) -> str:
         'data/ticker=RDS_A.pkl'
         >>> target_file_name('data/{corp}', corp='E*TRADE FUTURES LLC')
         'data/E@TRADE FUTURES LLC'
+        >>> target_file_name('data/{ticker}.pkl', ticker='ES1', px=pd.DataFrame())
+        'data/ES1.pkl'
     """
+    # Only arguments in format are converted to str
+    names = {fld for _, fld, _, _ in string.Formatter().parse(fmt) if fld}
     return utils.fstr(
         fmt=fmt,
         **{
@@ -139,46 +1596,334 @@ def target_file_name(fmt: str, **kwargs) -> str:
             .replace(':', ' -')
             .replace('\\', '/')
             .replace('/', '_')
-            for k, v in kwargs.items()
+            for k, v in kwargs.items() if k in names
         }
     )
 
 
+def hash_key(obj) -> str:
+    """
+    Stable content hash of arguments as fixed-length key
+
+    pandas objects are hashed with vectorized `pd.util.hash_pandas_object`,
+    numpy arrays by raw bytes, and containers recursively - dict and set are
+    independent of order, and objects are hashed by their attributes
+
+    Args:
+        obj: object to hash
+
+    Returns:
+        str: 32-char hex digest
+
+    Examples:
+        >>> px = pd.DataFrame({'ES1': [3000, 3010]})
+        >>> key = hash_key({'tickers': ['ES1', 'NQ1'], 'px': px})
+        >>> len(key), key == hash_key({'px': px.copy(), 'tickers': ['ES1', 'NQ1']})
+        (32, True)
+        >>> key == hash_key({'tickers': ['ES1', 'NQ1'], 'px': px + 1})
+        False
+        >>> hash_key(np.arange(3)) == hash_key(np.arange(3.)), hash_key(1) == hash_key('1')
+        (False, False)
+    """
+    h = hashlib.blake2b(digest_size=16)
+    _feed_(h, obj)
+    return h.hexdigest()
+
+
+def _feed_(h, obj):
+    """
+    Feed object into hash
+    """
+    def tag(name, *info):
+        h.update(f'<{name}:{info!r}>'.encode())
+
+    if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        if isinstance(obj, pd.DataFrame):
+            tag('DataFrame', obj.shape, [str(dt) for dt in obj.dtypes])
+            _feed_(h, list(obj.columns))
+        elif isinstance(obj, pd.Series):
+            tag('Series', obj.shape, str(obj.dtype))
+            _feed_(h, obj.name)
+        else:
+            tag('Index', obj.shape, str(obj.dtype), obj.names)
+        try:
+            hashed = pd.util.hash_pandas_object(obj, index=not isinstance(obj, pd.Index))
+        except TypeError:
+            # Unhashable values in object columns
+            h.update(pickle.dumps(obj, protocol=4))
+            return
+        if not isinstance(obj, pd.Index): _feed_(h, obj.index)
+        h.update(np.ascontiguousarray(hashed.values).tobytes())
+    elif isinstance(obj, np.ndarray):
+        tag('ndarray', obj.shape, obj.dtype.str)
+        if obj.dtype.hasobject: _feed_(h, obj.tolist())
+        else: h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, np.generic):
+        tag(type(obj).__name__, obj.tobytes())
+    elif (obj is None) or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        tag(type(obj).__name__, obj)
+    elif isinstance(obj, dict):
+        tag('dict', len(obj))
+        for k, v in sorted(((hash_key(k), v) for k, v in obj.items()), key=lambda kv: kv[0]):
+            h.update(k.encode())
+            _feed_(h, v)
+    elif isinstance(obj, (list, tuple)):
+        tag(type(obj).__name__, len(obj))
+        for v in obj: _feed_(h, v)
+    elif isinstance(obj, (set, frozenset)):
+        tag('set', len(obj))
+        for k in sorted(hash_key(v) for v in obj): h.update(k.encode())
+    elif callable(obj):
+        tag('callable', getattr(obj, '__module__', ''), getattr(obj, '__qualname__', repr(obj)))
+    elif hasattr(obj, '__dict__'):
+        tag(f'{type(obj).__module__}.{type(obj).__qualname__}')
+        _feed_(h, vars(obj))
+    else:
+        try:
+            h.update(pickle.dumps(obj, protocol=4))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            tag(type(obj).__name__, repr(obj))
+
+
+def args_file_name(data_file: str, key: str) -> str:
+    """
+    File of original arguments for data file cached with hashed key
+
+    Examples:
+        >>> args_file_name('/data/px/3c1e/2020-01-02.pkl', key='3c1e')
+        '/data/px/3c1e/.args-3c1e.pkl'
+    """
+    path = os.path.split(data_file.replace('\\', '/'))[0]
+    return f'{path}/.args-{key}.pkl'
+
+
+def save_args(args: dict, args_file: str):
+    """
+    Save original arguments of hashed key - kept if already saved
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     save_args({'tickers': ['ES1', 'NQ1']}, args_file=f'{tmp}/.args-3c1e.pkl')
+        ...     pd.read_pickle(f'{tmp}/.args-3c1e.pkl')
+        {'tickers': ['ES1', 'NQ1']}
+    """
+    if files.exists(args_file): return
+    tmp_file = temp_file_name(args_file)
+    try:
+        with open(tmp_file, 'wb') as fp:
+            pickle.dump(args, fp, protocol=4)
+        os.replace(tmp_file, args_file)
+    except Exception as e:
+        logs.get_logger(save_args).warning(f'Cannot save arguments to {args_file}: {e}')
+        if files.exists(tmp_file): os.remove(tmp_file)
+
+
 def load_file(data_file: str, load_func=None, **kwargs):
     """
     Load data from cache
+
+    Args:
+        data_file: file name
+        load_func: custom function to load data
+        **kwargs:
+            _columns_: list of columns to load
+            _filters_: row filters in pyarrow format
+                       both are pushed down to pyarrow for parquet files,
+                       and columns for memory mapped arrow / feather files
     """
     logger = logs.get_logger(load_file, level=kwargs.get('log', 'info'))
     if (not data_file) or (not files.exists(data_file)): return
 
-    if callable(load_func): return load_func(data_file)
+    columns = kwargs.get('_columns_', None)
+    filters = kwargs.get('_filters_', None)
+    if callable(load_func):
+        return select_data(data=load_func(data_file), columns=columns, filters=filters)
 
     ext = data_file.split('.')[-1]
     if ext not in LOAD_FUNC: return
 
     logger.debug(f'Reading from {data_file} ...')
-    return LOAD_FUNC[ext](data_file)
+    if ext == 'parq':
+        read_kw = {}
+        if columns is not None: read_kw['columns'] = list(columns)
+        if filters: read_kw['filters'] = filters
+        return LOAD_FUNC[ext](data_file, **read_kw)
+    if ext in ['arrow', 'feather']:
+        read_cols = columns
+        if (columns is not None) and filters:
+            # Columns in filters are needed for row selection
+            conj = filters if isinstance(filters[0][0], (list, tuple)) else [filters]
+            read_cols = list(columns) + [
+                f[0] for c in conj for f in c if f[0] not in columns
+            ]
+        return select_data(
+            data=LOAD_FUNC[ext](data_file, columns=read_cols), columns=columns, filters=filters,
+        )
+    return select_data(data=LOAD_FUNC[ext](data_file), columns=columns, filters=filters)
+
+
+def _load_(data_file: str, load_func=None, mem_cache=False, stats=None, kwargs=None):
+    """
+    Load data from memory or disk - MISSING if file does not exist
+    Full data is kept in memory and columns / filters are applied afterwards,
+    unless they can be pushed down to parquet files
+
+    Args:
+        data_file: file name
+        load_func: custom function to load data
+        mem_cache: look up / keep data in MEM_CACHE
+        stats: metrics.Metrics to record load latency and bytes read
+        kwargs: keyword arguments of function call
+    """
+    if kwargs is None: kwargs = dict()
+    columns = kwargs.get('_columns_', None)
+    filters = kwargs.get('_filters_', None)
+    selected = (columns is not None) or bool(filters)
+
+    if mem_cache:
+        data = MEM_CACHE.get(data_file)
+        if data is not MISSING:
+            if stats is not None: stats.inc('mem_hits')
+            return select_data(data=data, columns=columns, filters=filters)
+    if not files.exists(data_file): return MISSING
+
+    start = time.perf_counter()
+    pushdown = (not callable(load_func)) and (data_file.split('.')[-1] == 'parq')
+    if (not mem_cache) or (selected and pushdown):
+        data = load_file(data_file=data_file, load_func=load_func, **kwargs)
+    else:
+        full_kw = {k: v for k, v in kwargs.items() if k not in ['_columns_', '_filters_']}
+        mtime = _mtime_(data_file)
+        data = load_file(data_file=data_file, load_func=load_func, **full_kw)
+        MEM_CACHE.put(data_file, data=data, mtime=mtime)
+        data = select_data(data=data, columns=columns, filters=filters)
+
+    if stats is not None:
+        stats.observe('load_seconds', time.perf_counter() - start)
+        stats.inc('bytes_read', _fsize_(data_file))
+    return data
+
+
+def _fsize_(data_file: str) -> int:
+    """
+    File size in bytes - 0 if file does not exist
+    """
+    try:
+        return os.path.getsize(data_file)
+    except OSError:
+        return 0
+
+
+def select_data(data, columns=None, filters=None):
+    """
+    Select columns and filter rows in the same way as parquet pushdown
 
+    Args:
+        data: data - anything other than DataFrame is returned as is
+        columns: list of columns - index is always kept
+        filters: list of (column, op, value) combined with AND, or
+                 list of such lists combined with OR
+                 columns can also be index names
+
+    Returns:
+        data
+
+    Examples:
+        >>> sample = pd.DataFrame({
+        ...     'ticker': ['ES1', 'NQ1', 'ES1'],
+        ...     'price': [3000, 10000, 3010],
+        ...     'volume': [10, 20, 30],
+        ... }, index=pd.Index([1, 2, 3], name='sid'))
+        >>> select_data(sample, columns=['price'], filters=[('ticker', '=', 'ES1')]).to_dict()
+        {'price': {1: 3000, 3: 3010}}
+        >>> select_data(sample, filters=[[('sid', '<', 2)], [('volume', '>=', 30)]]).index.tolist()
+        [1, 3]
+        >>> select_data(sample, filters=[('ticker', 'not in', ['ES1'])]).index.tolist()
+        [2]
+    """
+    if not isinstance(data, pd.DataFrame): return data
+    if filters:
+        if not isinstance(filters[0][0], (list, tuple)): filters = [filters]
+        mask = np.zeros(len(data), dtype=bool)
+        for conj in filters:
+            conj_mask = np.ones(len(data), dtype=bool)
+            for col, op, val in conj:
+                if col in data.columns: vals = data[col]
+                else: vals = data.index.get_level_values(col)
+                conj_mask &= np.asarray(FILTER_OPS[op](vals, val), dtype=bool)
+            mask |= conj_mask
+        data = data.loc[mask]
+    if columns is not None: data = data.loc[:, list(columns)]
+    return data
 
-def save_file(data, data_file: str, save_func=None, **kwargs):
+
+def save_file(data, data_file: str, save_func=None, compression=None, compression_level=None, **kwargs):
     """
     Save data
+
+    Data is written to a temporary file in the same folder first and then
+    renamed to data_file, so readers never see partially written files
+
+    Args:
+        data: data to save
+        data_file: file name
+        save_func: custom function to save data
+        compression: compression codec for pkl, parq, arrow or feather files
+        compression_level: compression level - codec default if None
     """
     logger = logs.get_logger(save_file, level=kwargs.get('log', 'info'))
     if not data_file: return
     if isinstance(data, (pd.Series, pd.DataFrame)) and data.empty: return
 
+    ext = data_file.split('.')[-1]
+    if not callable(save_func):
+        if callable(SAVE_FUNC.get(ext, None)):
+            if not isinstance(data, pd.DataFrame): return
+        elif not hasattr(data, SAVE_FUNC.get(ext, '__nothing__')): return
+        save_kw = compression_kwargs(
+            ext=ext, compression=compression, compression_level=compression_level,
+        )
+        if ext in ['csv', 'xls', 'xlsx']: save_kw['index'] = False
+
     files.create_folder(data_file, is_file=True)
-    if callable(save_func):
-        logger.debug(f'Saving data to {data_file} ...')
-        save_func(data=data, data_file=data_file)
+    tmp_file = temp_file_name(data_file)
+    logger.debug(f'Saving data to {data_file} ...')
+    try:
+        if callable(save_func):
+            save_func(data=data, data_file=tmp_file)
+        elif callable(SAVE_FUNC[ext]):
+            SAVE_FUNC[ext](data, tmp_file, **save_kw)
+        else:
+            getattr(data, SAVE_FUNC[ext])(tmp_file, **save_kw)
+        if files.exists(tmp_file): os.replace(tmp_file, data_file)
+    finally:
+        if files.exists(tmp_file): os.remove(tmp_file)
 
-    ext = data_file.split('.')[-1]
-    save_kw = {}
-    if ext in ['csv', 'xls', 'xlsx']: save_kw['index'] = False
 
-    save_func = SAVE_FUNC.get(ext, '__nothing__')
-    if not hasattr(data, save_func): return
+def temp_file_name(data_file: str) -> str:
+    """
+    Unique temporary file name in the same folder with the same extension
+    File names starting with `~` are ignored by `files.all_files`
 
-    logger.debug(f'Saving data to {data_file} ...')
-    getattr(data, save_func)(data_file, **save_kw)
+    Examples:
+        >>> tmp_file = temp_file_name('/data/daily/2020-01-02.pkl')
+        >>> tmp_file.startswith('/data/daily/~2020-01-02.'), tmp_file.endswith('.pkl')
+        (True, True)
+    """
+    path, name = os.path.split(data_file.replace('\\', '/'))
+    base, ext = os.path.splitext(name)
+    return f'{path}/~{base}.{os.getpid()}-{uuid.uuid4().hex[:8]}{ext}'
+
+
+def lock_file_name(data_file: str) -> str:
+    """
+    Lock file name for data file
+
+    Examples:
+        >>> lock_file_name('/data/daily/2020-01-02.pkl')
+        '/data/daily/~2020-01-02.pkl.lock'
+    """
+    path, name = os.path.split(data_file.replace('\\', '/'))
+    return f'{path}/~{name}.lock'
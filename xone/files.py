@@ -27,6 +27,83 @@ def exists(path) -> bool:
     return os.path.exists(path=path)
 
 
+class FileLock(object):
+    """
+    Exclusive lock across processes based on lock file
+    Lock file is kept after release so waiting processes lock the same file
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     with FileLock(f'{tmp}/sample.lock') as lock:
+        ...         lock.locked
+        ...     lock.locked
+        True
+        False
+    """
+
+    def __init__(self, lock_file: str):
+
+        self.lock_file = lock_file
+        self._fd_ = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd_ is not None
+
+    def acquire(self):
+        """
+        Wait until lock is acquired
+        """
+        create_folder(self.lock_file, is_file=True)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.name == 'nt':
+                import msvcrt
+
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+            else:
+                import fcntl
+
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd_ = fd
+
+    def release(self):
+        """
+        Release lock
+        """
+        if self._fd_ is None: return
+        try:
+            if os.name == 'nt':
+                import msvcrt
+
+                os.lseek(self._fd_, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd_, msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(self._fd_, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd_)
+            self._fd_ = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
 def abspath(cur_file, parent=0) -> Path:
     """
     Absolute path
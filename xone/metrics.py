@@ -0,0 +1,181 @@
+import threading
+
+from collections import OrderedDict
+
+# Upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (.001, .005, .01, .05, .1, .5, 1., 5., 10., 60.)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values
+
+    Examples:
+        >>> hist = Histogram(buckets=(.1, 1.))
+        >>> for v in [.05, .5, 2.]: hist.observe(v)
+        >>> hist.to_dict()
+        {'buckets': {0.1: 1, 1.0: 2, inf: 3}, 'sum': 2.55, 'count': 3}
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        for n, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[n] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        cum, res = 0, OrderedDict()
+        for upper, cnt in zip(self.buckets, self.counts):
+            cum += cnt
+            res[upper] = cum
+        return dict(buckets=dict(res), sum=round(self.sum, 6), count=self.count)
+
+
+class Metrics(object):
+    """
+    Counters and histograms of one target, e.g., one cached function
+
+    Examples:
+        >>> m = Metrics(name='sample')
+        >>> m.inc('hits')
+        >>> m.inc('bytes_read', 1024)
+        >>> m.observe('load_seconds', .02)
+        >>> res = m.to_dict()
+        >>> res['hits'], res['bytes_read'], res['load_seconds']['count']
+        (1, 1024, 1)
+    """
+
+    def __init__(self, name: str):
+
+        self.name = name
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self._lock_ = threading.Lock()
+
+    def inc(self, key: str, value=1):
+        with self._lock_:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, key: str, value: float):
+        with self._lock_:
+            if key not in self.histograms: self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def clear(self):
+        with self._lock_:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock_:
+            return {
+                **self.counters,
+                **{k: v.to_dict() for k, v in self.histograms.items()},
+            }
+
+
+REGISTRY = OrderedDict()
+_REGISTRY_LOCK_ = threading.Lock()
+
+
+def get_metrics(name: str) -> Metrics:
+    """
+    Metrics of given name in registry - created if not exists
+
+    Examples:
+        >>> get_metrics('xone.sample') is get_metrics('xone.sample')
+        True
+    """
+    with _REGISTRY_LOCK_:
+        if name not in REGISTRY: REGISTRY[name] = Metrics(name=name)
+        return REGISTRY[name]
+
+
+def to_dict() -> dict:
+    """
+    All metrics in registry as dict
+    """
+    with _REGISTRY_LOCK_:
+        all_metrics = list(REGISTRY.values())
+    return {m.name: m.to_dict() for m in all_metrics}
+
+
+def reset():
+    """
+    Reset values of all metrics in registry (objects are kept for their holders)
+    """
+    with _REGISTRY_LOCK_:
+        for m in REGISTRY.values(): m.clear()
+
+
+def to_prometheus(prefix='xone', label='name') -> str:
+    """
+    All metrics in registry in Prometheus text format
+
+    Args:
+        prefix: prefix of metric names
+        label: label name of metrics names in registry
+
+    Returns:
+        str
+
+    Examples:
+        >>> reset()
+        >>> m = get_metrics('sample')
+        >>> m.inc('hits', 2)
+        >>> m.observe('load_seconds', .02)
+        >>> print(to_prometheus(prefix='xone_cache'))  # doctest: +ELLIPSIS
+        # TYPE xone_cache_hits_total counter
+        xone_cache_hits_total{name="sample"} 2
+        # TYPE xone_cache_load_seconds histogram
+        xone_cache_load_seconds_bucket{name="sample",le="0.001"} 0
+        ...
+        xone_cache_load_seconds_bucket{name="sample",le="+Inf"} 1
+        xone_cache_load_seconds_sum{name="sample"} 0.02
+        xone_cache_load_seconds_count{name="sample"} 1
+        >>> reset()
+    """
+    with _REGISTRY_LOCK_:
+        all_metrics = list(REGISTRY.values())
+
+    counters, histograms = OrderedDict(), OrderedDict()
+    for m in all_metrics:
+        res = m.to_dict()
+        lbl = f'{label}="{_escape_(m.name)}"'
+        for key, val in res.items():
+            if isinstance(val, dict): histograms.setdefault(key, []).append((lbl, val))
+            else: counters.setdefault(key, []).append((lbl, val))
+
+    lines = []
+    for key, values in counters.items():
+        lines.append(f'# TYPE {prefix}_{key}_total counter')
+        lines += [f'{prefix}_{key}_total{{{lbl}}} {val}' for lbl, val in values]
+    for key, values in histograms.items():
+        lines.append(f'# TYPE {prefix}_{key} histogram')
+        for lbl, val in values:
+            for upper, cnt in val['buckets'].items():
+                le = '+Inf' if upper == float('inf') else repr(upper)
+                lines.append(f'{prefix}_{key}_bucket{{{lbl},le="{le}"}} {cnt}')
+            lines.append(f'{prefix}_{key}_sum{{{lbl}}} {val["sum"]}')
+            lines.append(f'{prefix}_{key}_count{{{lbl}}} {val["count"]}')
+    return '\n'.join(lines)
+
+
+def _escape_(value: str) -> str:
+    """
+    Escape label value for Prometheus
+
+    Examples:
+        >>> _escape_('a"b')
+        'a\\\\"b'
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
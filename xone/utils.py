@@ -417,9 +417,9 @@ def func_kwarg(func, **kwargs) -> dict:
     if not callable(func): return {}
 
     param = inspect.signature(func).parameters
-    kind = pd.Series({k: v.kind for k, v in param.items()})
-    if kind.max() == 4: return kwargs
-    return {k: v for k, v in kwargs.items() if k in kind}
+    if any(v.kind == inspect.Parameter.VAR_KEYWORD for v in param.values()):
+        return kwargs
+    return {k: v for k, v in kwargs.items() if k in param}
 
 
 def perf(data: Union[pd.DataFrame, pd.Series]) -> Union[pd.DataFrame, pd.Series]:
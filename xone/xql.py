@@ -1,11 +1,49 @@
+import numpy as np
 import pandas as pd
 
+import os
+import asyncio
+import atexit
+import datetime
 import sqlite3
 import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from xone import logs
 
-WAL_MODE = 'PRAGMA journal_mode=WAL'
 ALL_TABLES = 'SELECT name FROM sqlite_master WHERE type="table"'
 
+# Connections inherited from parent processes - never used or closed
+_FORKED_ = []
+
+# Pooled connections idle for longer than this (in seconds) are reopened
+IDLE_TIMEOUT = 300.
+
+# Warn if select with filters scans full table with more rows than this - disabled if 0
+SCAN_WARN_ROWS = 0
+# Max number of queries kept as checked for full scans
+SCAN_CHECKED = 1000
+
+# Threads for reads of AsyncSQLite
+ASYNC_WORKERS = 4
+
+# Write-behind buffer: records to trigger write, max seconds in buffer and max pending records
+WRITE_ROWS = 1000
+WRITE_INTERVAL = 1.
+WRITE_MAX_PENDING = 100000
+
+# Rows per executemany call of bulk writes
+CHUNK_SIZE = 50000
+# Pragmas of bulk writes - restored afterwards
+BULK_PRAGMAS = {'synchronous': 'NORMAL', 'cache_size': -64000}
+
+
+_SINGLETON_LOCK_ = threading.Lock()
+
 
 class Singleton(type):
 
@@ -13,19 +51,31 @@ class Singleton(type):
 
     def __call__(cls, *args, **kwargs):
         # Default values for class init
-        default_keys = ['db_file', 'keep_live']
+        default_keys = ['db_file', 'keep_live', 'journal_mode']
         kw = {**dict(zip(default_keys, args)), **kwargs}
         kw['keep_live'] = kw.get('keep_live', False)
+        kw['journal_mode'] = kw.get('journal_mode', 'WAL')
 
-        # Singleton instance
-        key = json.dumps(kw)
+        # Singleton instance - created once across threads
+        key = json.dumps(kw, sort_keys=True)
         if key not in cls._instances_:
-            cls._instances_[key] = super(Singleton, cls).__call__(**kw)
+            with _SINGLETON_LOCK_:
+                if key not in cls._instances_:
+                    cls._instances_[key] = super(Singleton, cls).__call__(**kw)
         return cls._instances_[key]
 
 
 class SQLite(metaclass=Singleton):
     """
+    SQLite database with pooled connections - one connection per thread,
+    kept open across queries and reopened after IDLE_TIMEOUT
+
+    Instances are safe to share across threads, and connections inherited
+    from parent process are not used after fork - new ones are opened
+
+    Journal mode is WAL by default - use journal_mode='DELETE' for databases
+    on network file systems, where WAL is not supported
+
     Examples:
         >>> from xone import files
         >>>
@@ -49,32 +99,114 @@ class SQLite(metaclass=Singleton):
         0      1
         1      2
         2      3
+        >>> db_.select(table='xone', rowid=[1, 3])
+           rowid
+        0      1
+        1      3
+        >>> [chunk['rowid'].tolist() for chunk in db_.select_chunks('xone', chunk_size=2)]
+        [[1, 2], [3]]
+        >>> chunks = db_.select_chunks('xone', chunk_size=2)
+        >>> next(chunks)['rowid'].tolist()
+        [1, 2]
+        >>> db_.close_idle(timeout=0), [chunk['rowid'].tolist() for chunk in chunks]
+        (0, [[3]])
+        >>> db_.is_live, db_.close_idle(timeout=0), db_.is_live
+        (True, 1, False)
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> with ThreadPoolExecutor(max_workers=4) as pool:
+        ...     list(pool.map(lambda r: db_.select('xone', rowid=r).shape[0], [1, 2, 3, 4]))
+        [1, 1, 1, 0]
     """
 
-    def __init__(self, db_file, keep_live=False):
+    def __init__(self, db_file, keep_live=False, journal_mode='WAL'):
 
         self.db_file = db_file
         self.keep_live = keep_live
-        self._con_ = None
+        self.journal_mode = journal_mode
+        # Table schemas: table -> (schema version, declared types of columns)
+        self._schema_ = dict()
+        # Queries checked for full scans under schema version of the first element
+        self._plans_ = [None, set()]
+        self._reset_()
+
+    def _reset_(self):
+        """
+        Empty connection pool of current process
+        """
+        # Pooled connections of threads: thread id -> (connection, last used time)
+        self._pool_ = dict()
+        self._lock_ = threading.Lock()
+        self._local_ = threading.local()
+        # Open streams of select_chunks: id of connection -> number of streams
+        self._streams_ = dict()
+        self._pid_ = os.getpid()
+
+    def _check_pid_(self):
+        """
+        Drop connections inherited from parent process after fork
+        They are kept referenced without closing - closing them in child process
+        could affect locks of the same database in parent process
+        """
+        if self._pid_ == os.getpid(): return
+        _FORKED_.extend(con for con, _ in self._pool_.values())
+        self._reset_()
 
     def tables(self) -> list:
         """
         All tables within database
         """
-        keep_live = self.is_live
         res = self.con.execute(ALL_TABLES).fetchall()
-        if not keep_live: self.close()
         return [r[0] for r in res]
 
     def select(self, table: str, cond='', **kwargs) -> pd.DataFrame:
         """
         SELECT query
         """
-        keep_live = self.is_live
-        q_str = select(table=table, cond=cond, **kwargs)
-        data = self.con.execute(q_str).fetchall()
-        if not keep_live: self.close()
-        return pd.DataFrame(data, columns=self.columns(table=table))
+        q_str, params = select_query(table=table, cond=cond, **kwargs)
+        if SCAN_WARN_ROWS and (cond or kwargs): self._check_scan_(table, q_str, params)
+        cur = self.con.execute(q_str, params)
+        return pd.DataFrame(cur.fetchall(), columns=[desc[0] for desc in cur.description])
+
+    def select_chunks(self, table: str, cond='', chunk_size=CHUNK_SIZE, **kwargs):
+        """
+        SELECT query in chunks - rows are fetched and converted to DataFrame chunk by chunk,
+        so tables larger than memory can be processed with bounded memory
+
+        Columns declared as integers are nullable Int64 and as reals float64 in all chunks
+
+        Args:
+            table: table name
+            cond: conditions
+            chunk_size: number of rows in each chunk
+            **kwargs: other select criteria
+
+        Yields:
+            pd.DataFrame
+        """
+        # Numeric columns have the same dtypes in all chunks, with or without NULL values
+        dtypes = {
+            col: num_dtype(decl) for col, decl in self._decl_types_(table=table).items()
+            if num_dtype(decl)
+        }
+        q_str, params = select_query(table=table, cond=cond, **kwargs)
+        if SCAN_WARN_ROWS and (cond or kwargs): self._check_scan_(table, q_str, params)
+        con = self.con
+        cur = con.execute(q_str, params)
+        columns = [desc[0] for desc in cur.description]
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in columns}
+        # Connection is not closed as idle while rows are being fetched
+        with self._lock_:
+            self._streams_[id(con)] = self._streams_.get(id(con), 0) + 1
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows: break
+                yield _frame_(rows, columns=columns, dtypes=dtypes)
+        finally:
+            cur.close()
+            with self._lock_:
+                self._streams_[id(con)] -= 1
+                if not self._streams_[id(con)]: self._streams_.pop(id(con))
 
     def select_recent(
             self,
@@ -82,20 +214,38 @@ class SQLite(metaclass=Singleton):
             dateperiod: str,
             date_col: str = 'modified_date',
             cond='',
+            index=False,
             **kwargs
     ) -> pd.DataFrame:
         """
-        Select recent
+        Select recent - date bound is filtered in database
 
         Args:
             table: table name
             dateperiod: time period, e.g., 1M, 1Q, etc.
-            date_col: column for time period
+            date_col: column for time period - dates in format of YYYY-MM-DD[ HH:MM:SS]
             cond: conditions
+            index: create index on date_col if not exists
             **kwargs: other select criteria
 
         Returns:
             pd.DataFrame
+
+        Examples:
+            >>> import tempfile
+            >>>
+            >>> tmp = tempfile.TemporaryDirectory()
+            >>> db = SQLite(f'{tmp.name}/audit.db')
+            >>> with db: _ = db.con.execute('CREATE TABLE audit (name text, modified_date text)')
+            >>> today = pd.Timestamp('today').normalize()
+            >>> db.replace_into('audit', data=pd.DataFrame({
+            ...     'name': ['old', 'new'],
+            ...     'modified_date': [today - pd.Timedelta('400D'), today],
+            ... }))
+            >>> db.select_recent('audit', dateperiod='1W', index=True)['name'].tolist()
+            ['new']
+            >>> db.close()
+            >>> tmp.cleanup()
         """
         cols = self.columns(table=table)
         if date_col not in cols: return pd.DataFrame()
@@ -105,25 +255,43 @@ class SQLite(metaclass=Singleton):
             )[0]
             .strftime('%Y-%m-%d')
         )
-        return (
-            self.select(table=table, cond=cond, **kwargs)
-            .query(f'{date_col} >= {start_dt}')
-            .reset_index(drop=True)
+        if index: self.create_index(table=table, columns=date_col)
+        return self.select(
+            table=table,
+            cond=' AND '.join(filter(bool, [
+                f'({cond})' if cond else '', f"`{date_col}` >= '{start_dt}'",
+            ])),
+            **kwargs
         )
 
     def columns(self, table: str):
         """
         Table columns
         """
-        return [
-            info[1] for info in (
-                self.con.execute(f'PRAGMA table_info (`{table}`)').fetchall()
+        return list(self._decl_types_(table=table))
+
+    def _decl_types_(self, table: str) -> dict:
+        """
+        Declared types of table columns
+        Cached until schema of database changes, checked with `PRAGMA schema_version`
+        """
+        con = self.con
+        version = con.execute('PRAGMA schema_version').fetchone()[0]
+        cached = self._schema_.get(table, None)
+        if (cached is not None) and (cached[0] == version): return cached[1]
+        decl = {
+            info[1]: info[2] for info in (
+                con.execute(f'PRAGMA table_info (`{table}`)').fetchall()
             )
-        ]
+        }
+        self._schema_[table] = (version, decl)
+        return decl
 
     def replace_into(self, table: str, data: pd.DataFrame = None, **kwargs):
         """
         Replace records into table
+        Changes are committed unless called within `with` block of this database or with _live_=True,
+        where they are committed at the end of the block or by `close`
 
         Args:
             table: table name
@@ -131,52 +299,779 @@ class SQLite(metaclass=Singleton):
             **kwargs: record values
         """
         if isinstance(data, pd.DataFrame):
-            keep_live = self.is_live
             cols = ', '.join(map(lambda v: f'`{v}`', data.columns))
             vals = ', '.join(['?'] * data.shape[1])
-            # noinspection PyTypeChecker
-            self.con.executemany(
-                f'REPLACE INTO `{table}` ({cols}) values ({vals})',
-                data.apply(tuple, axis=1).tolist()
+            q_str = f'REPLACE INTO `{table}` ({cols}) values ({vals})'
+            with self._bulk_() as con:
+                for rows in frame_rows(data):
+                    con.executemany(q_str, rows)
+        else:
+            with self._transaction_(keep_live=kwargs.get('_live_', False)) as con:
+                con.execute(*replace_query(table=table, **{
+                    k: v for k, v in kwargs.items() if k != '_live_'
+                }))
+
+    def upsert_frame(
+            self,
+            table: str,
+            data: pd.DataFrame,
+            primary_key=None,
+            indexes=None,
+            chunk_size=CHUNK_SIZE,
+    ):
+        """
+        Insert or update rows of DataFrame by primary key
+        Table is created with schema inferred from dtypes if not exists, and missing columns
+        are added - all rows are loaded with batches of executemany in one transaction
+
+        Args:
+            table: table name
+            data: DataFrame
+            primary_key: column or list of columns of primary key for new table,
+                         rows with existing keys are updated - rows are inserted only if None
+                         unique index is created for existing table without this key
+            indexes: list of columns (or lists of columns) to index
+            chunk_size: number of rows in each batch
+
+        Examples:
+            >>> import tempfile
+            >>>
+            >>> tmp = tempfile.TemporaryDirectory()
+            >>> db = SQLite(f'{tmp.name}/daily.db')
+            >>> px = pd.DataFrame({'ticker': ['ES1', 'NQ1'], 'price': [3000., 9000.]})
+            >>> db.upsert_frame('daily', data=px, primary_key='ticker', indexes=['price'])
+            >>> db.upsert_frame('daily', data=pd.DataFrame({
+            ...     'ticker': ['NQ1', 'VG1'], 'price': [9010., 3500.], 'volume': [100, 200],
+            ... }), primary_key='ticker')
+            >>> db.select('daily')['ticker'].tolist()
+            ['ES1', 'NQ1', 'VG1']
+            >>> db.select('daily', ticker='NQ1').values.tolist()
+            [['NQ1', 9010.0, 100]]
+            >>> db._decl_types_('daily')
+            {'ticker': 'TEXT', 'price': 'REAL', 'volume': 'INTEGER'}
+            >>> with db:
+            ...     db.replace_into('daily', ticker='ES1', price=3010.)
+            ...     db.upsert_frame('daily', data=px.iloc[1:], primary_key='ticker')
+            >>> db.select('daily', ticker=['ES1', 'NQ1'])['price'].tolist()
+            [3010.0, 9000.0]
+            >>> with db: _ = db.con.execute('CREATE TABLE vol (ticker text, dt text, vol real)')
+            >>> for v in [.1, .2]:
+            ...     db.upsert_frame('vol', data=pd.DataFrame({
+            ...         'ticker': ['ES1'], 'dt': ['2020-01-02'], 'vol': [v],
+            ...     }), primary_key=['ticker', 'dt'])
+            >>> db.select('vol')['vol'].tolist(), db.indexes('vol')['name'].tolist()
+            ([0.2], ['idx_vol_ticker_dt'])
+            >>> db.close()
+            >>> tmp.cleanup()
+        """
+        if isinstance(primary_key, str): primary_key = [primary_key]
+        primary_key = list(primary_key or [])
+        schema = {col: sql_type(data[col].dtype) for col in data.columns}
+
+        with self._transaction_() as con:
+            existing = self._decl_types_(table=table)
+            if not existing:
+                defs = [f'`{col}` {typ}' for col, typ in schema.items()]
+                if primary_key:
+                    defs.append(f'PRIMARY KEY ({", ".join(f"`{k}`" for k in primary_key)})')
+                con.execute(f'CREATE TABLE IF NOT EXISTS `{table}` ({", ".join(defs)})')
+            else:
+                for col, typ in schema.items():
+                    if col in existing: continue
+                    con.execute(f'ALTER TABLE `{table}` ADD COLUMN `{col}` {typ}')
+
+        if existing and primary_key and (not self._is_unique_(table=table, columns=primary_key)):
+            try:
+                self.create_index(table=table, columns=primary_key, unique=True)
+            except sqlite3.IntegrityError as e:
+                raise ValueError(f'Duplicated {primary_key} in table {table}: {e}')
+        for idx in (indexes or []): self.create_index(table=table, columns=idx)
+
+        cols = ', '.join(f'`{col}`' for col in data.columns)
+        q_str = f'INSERT INTO `{table}` ({cols}) VALUES ({", ".join(["?"] * data.shape[1])})'
+        if primary_key:
+            updates = ', '.join(
+                f'`{col}`=excluded.`{col}`' for col in data.columns if col not in primary_key
+            )
+            conflict = ', '.join(f'`{k}`' for k in primary_key)
+            q_str += f' ON CONFLICT ({conflict}) ' + (
+                f'DO UPDATE SET {updates}' if updates else 'DO NOTHING'
+            )
+        with self._bulk_() as con:
+            for rows in frame_rows(data, chunk_size=chunk_size):
+                con.executemany(q_str, rows)
+
+    def _is_unique_(self, table: str, columns: list) -> bool:
+        """
+        Whether columns are primary key or have unique index in table
+        """
+        pk = [info[1] for info in self.con.execute(f'PRAGMA table_info (`{table}`)') if info[5]]
+        if set(pk) == set(columns): return True
+        idx = self.indexes(table=table)
+        return any(set(cols) == set(columns) for cols in idx.loc[idx['unique'], 'columns'])
+
+    def create_index(self, table: str, columns, name=None, unique=False) -> str:
+        """
+        Create index on columns of table if not exists
+
+        Args:
+            table: table name
+            columns: column or list of columns
+            name: index name - default idx_{table}_{columns}
+            unique: unique index
+
+        Returns:
+            str: index name
+        """
+        if isinstance(columns, str): columns = [columns]
+        if name is None: name = f'idx_{table}_{"_".join(columns)}'
+        with self._transaction_() as con:
+            con.execute(
+                f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS `{name}` '
+                f'ON `{table}` ({", ".join(f"`{col}`" for col in columns)})'
             )
+        return name
+
+    def indexes(self, table: str) -> pd.DataFrame:
+        """
+        Indexes of table
+
+        Args:
+            table: table name
+
+        Returns:
+            pd.DataFrame: name, columns, unique and origin of indexes,
+                          origin is c for created, u for UNIQUE constraint and pk for primary key
+
+        Examples:
+            >>> import tempfile
+            >>>
+            >>> tmp = tempfile.TemporaryDirectory()
+            >>> db = SQLite(f'{tmp.name}/daily.db')
+            >>> with db: _ = db.con.execute('CREATE TABLE daily (ticker text, dt text, price real)')
+            >>> db.create_index('daily', columns=['ticker', 'dt'], unique=True)
+            'idx_daily_ticker_dt'
+            >>> db.indexes('daily').values.tolist()
+            [['idx_daily_ticker_dt', ['ticker', 'dt'], True, 'c']]
+            >>> db.explain('daily', ticker='ES1')
+            ['SEARCH daily USING INDEX idx_daily_ticker_dt (ticker=?)']
+            >>> db.drop_index('idx_daily_ticker_dt')
+            >>> db.indexes('daily').shape[0], db.explain('daily', ticker='ES1')
+            (0, ['SCAN daily'])
+            >>> db.close()
+            >>> tmp.cleanup()
+        """
+        con = self.con
+        res = [
+            [
+                name,
+                [info[2] for info in con.execute(f'PRAGMA index_info (`{name}`)').fetchall()],
+                bool(unique),
+                origin,
+            ]
+            for _, name, unique, origin, *_ in con.execute(f'PRAGMA index_list (`{table}`)').fetchall()
+        ]
+        return pd.DataFrame(res, columns=['name', 'columns', 'unique', 'origin'])
+
+    def drop_index(self, name: str):
+        """
+        Drop index if exists
+        """
+        with self._transaction_() as con:
+            con.execute(f'DROP INDEX IF EXISTS `{name}`')
+
+    def explain(self, table: str, cond='', **kwargs) -> list:
+        """
+        Query plan of select - same arguments as `select`
+
+        Returns:
+            list: details of steps from EXPLAIN QUERY PLAN
+        """
+        q_str, params = select_query(table=table, cond=cond, **kwargs)
+        version = self.con.execute('PRAGMA schema_version').fetchone()[0]
+        return self._plan_(q_str, params, version=version)
+
+    def _plan_(self, q_str: str, params: list, version: int) -> list:
+        """
+        EXPLAIN QUERY PLAN of query under schema version
+        Plans are made when statements are prepared and not updated for schema changes,
+        so schema version is kept in query to bypass statement cache of connection
+        """
+        return [
+            row[-1] for row in self.con.execute(
+                f'EXPLAIN QUERY PLAN {q_str} -- schema {version}', params
+            ).fetchall()
+        ]
+
+    def _check_scan_(self, table: str, q_str: str, params: list):
+        """
+        Warn if query scans full table with more than SCAN_WARN_ROWS rows
+        Each query is checked once until schema changes or SCAN_CHECKED queries are checked
+        """
+        con = self.con
+        version = con.execute('PRAGMA schema_version').fetchone()[0]
+        if (self._plans_[0] != version) or (len(self._plans_[1]) >= SCAN_CHECKED):
+            self._plans_ = [version, set()]
+        if q_str in self._plans_[1]: return
+        self._plans_[1].add(q_str)
+        if not any(map(is_full_scan, self._plan_(q_str, params, version=version))): return
+        try:
+            # Approximated by max rowid without counting rows
+            n_rows = con.execute(f'SELECT max(_rowid_) FROM `{table}`').fetchone()[0] or 0
+        except sqlite3.Error:
+            n_rows = con.execute(f'SELECT count(*) FROM `{table}`').fetchone()[0]
+        if n_rows <= SCAN_WARN_ROWS: return
+        logs.get_logger(SQLite, types='stream').warning(
+            f'Full scan of {table} with ~{n_rows} rows: {q_str} - '
+            f'consider index on filter columns (see `create_index`)'
+        )
+
+    @contextmanager
+    def _bulk_(self):
+        """
+        Transaction of bulk writes with BULK_PRAGMAS - pragmas are restored afterwards
+        Pragmas are skipped within pending transaction, e.g., in `with` block after other writes,
+        as safety level cannot be changed inside transaction
+        """
+        con = self.con
+        if con.in_transaction or getattr(self._local_, 'depth', 0):
+            with self._transaction_() as con:
+                yield con
+            return
+        pragmas = {
+            k: con.execute(f'PRAGMA {k}').fetchone()[0] for k in BULK_PRAGMAS
+        }
+        for k, v in BULK_PRAGMAS.items(): con.execute(f'PRAGMA {k}={v}')
+        try:
+            with self._transaction_() as con:
+                yield con
+        finally:
+            for k, v in pragmas.items(): con.execute(f'PRAGMA {k}={v}')
+
+    @contextmanager
+    def _transaction_(self, keep_live=False):
+        """
+        Connection of current thread - committed at the end unless in `with` block or keep_live
+        """
+        con = self.con
+        if keep_live or getattr(self._local_, 'depth', 0):
+            yield con
         else:
-            keep_live = self.is_live or kwargs.get('_live_', False)
-            self.con.execute(replace_into(table=table, **{
-                k: v for k, v in kwargs.items() if k != '_live_'
-            }))
-        if not keep_live: self.close()
+            with con: yield con
 
     @property
     def is_live(self) -> bool:
-        if not isinstance(self._con_, sqlite3.Connection):
-            return False
-        try:
-            self._con_.execute(ALL_TABLES)
-            return True
-        except sqlite3.Error:
-            return False
+        """
+        Whether current thread has an open connection in pool
+        """
+        self._check_pid_()
+        con, _ = self._pool_.get(threading.get_ident(), (None, 0.))
+        return _is_open_(con)
 
     @property
     def con(self) -> sqlite3.Connection:
-        if not self.is_live:
-            self._con_ = sqlite3.connect(self.db_file)
-            self._con_.execute(WAL_MODE)
-        return self._con_
+        """
+        Connection of current thread from pool
+        Connections idle for more than IDLE_TIMEOUT are reopened, unless keep_live is set
+        """
+        self._check_pid_()
+        tid = threading.get_ident()
+        now = time.monotonic()
+        con, last_used = self._pool_.get(tid, (None, 0.))
+        if (
+            (con is not None) and (not self.keep_live)
+            and (now - last_used > IDLE_TIMEOUT) and (not self._in_use_(con))
+        ):
+            con.close()
+        if not _is_open_(con):
+            # Connections are only used by their own threads, but can be closed by others
+            con = sqlite3.connect(self.db_file, check_same_thread=False)
+            con.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            self._prune_()
+        with self._lock_:
+            self._pool_[tid] = (con, now)
+        return con
+
+    def _in_use_(self, con) -> bool:
+        """
+        Whether open connection has pending transaction or open streams
+        """
+        if not _is_open_(con): return False
+        return con.in_transaction or (id(con) in self._streams_)
+
+    def _prune_(self):
+        """
+        Close connections of finished threads
+        """
+        alive = {t.ident for t in threading.enumerate()}
+        with self._lock_:
+            dead = [
+                tid for tid, (con, _) in self._pool_.items()
+                if (tid not in alive) and (not self._in_use_(con))
+            ]
+            cons = [self._pool_.pop(tid)[0] for tid in dead]
+        for con in cons:
+            try:
+                con.commit()
+                con.close()
+            except sqlite3.Error:
+                pass
 
     def close(self, keep_live=False):
+        """
+        Commit changes of current thread and close its connection unless keep_live
+        """
+        self._check_pid_()
+        with self._lock_:
+            con, _ = self._pool_.get(threading.get_ident(), (None, 0.))
+            if not keep_live: self._pool_.pop(threading.get_ident(), None)
         try:
-            self._con_.commit()
-            if not keep_live: self._con_.close()
+            if con is None: return
+            con.commit()
+            if not keep_live: con.close()
         except sqlite3.ProgrammingError:
             pass
         except sqlite3.Error as e:
             print(e)
 
+    def close_idle(self, timeout=None) -> int:
+        """
+        Close pooled connections of all threads idle for more than timeout (IDLE_TIMEOUT if None)
+        Connections with pending transactions or open streams of `select_chunks` are kept
+
+        Returns:
+            int: number of connections closed
+        """
+        self._check_pid_()
+        timeout = IDLE_TIMEOUT if timeout is None else timeout
+        now = time.monotonic()
+        with self._lock_:
+            idle = [
+                (tid, con) for tid, (con, last_used) in self._pool_.items()
+                if (now - last_used >= timeout) and (not self._in_use_(con))
+            ]
+            for tid, _ in idle: self._pool_.pop(tid, None)
+        for _, con in idle:
+            try:
+                con.close()
+            except sqlite3.Error:
+                pass
+        return len(idle)
+
     def __enter__(self):
+        self._local_.depth = getattr(self._local_, 'depth', 0) + 1
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close(keep_live=self.keep_live)
+        self._local_.depth -= 1
+        if self._local_.depth: return
+        self.close(keep_live=True)
+
+
+def _frame_(rows: list, columns: list, dtypes=None) -> pd.DataFrame:
+    """
+    DataFrame of fetched rows, with columns of given dtypes regardless of NULL values
+
+    Examples:
+        >>> dtypes = {'volume': 'Int64', 'price': 'float64'}
+        >>> _frame_([(1, None), (2, None)], columns=['volume', 'price'], dtypes=dtypes).dtypes.tolist()
+        [Int64Dtype(), dtype('float64')]
+        >>> _frame_([(None, 3000.)], columns=['volume', 'price'], dtypes=dtypes).dtypes.tolist()
+        [Int64Dtype(), dtype('float64')]
+    """
+    data = pd.DataFrame(rows, columns=columns)
+    for col, dtype in (dtypes or {}).items():
+        if data[col].dtype == dtype: continue
+        try:
+            data[col] = data[col].astype(dtype)
+        except (TypeError, ValueError):
+            # Values not of declared type are kept as they are
+            pass
+    return data
+
+
+def _is_open_(con) -> bool:
+    """
+    Cheap check of open connection without query
+    """
+    if not isinstance(con, sqlite3.Connection): return False
+    try:
+        con.in_transaction
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+
+class AsyncSQLite(object):
+    """
+    Async facade of SQLite - queries run in bounded thread pool of their own connections,
+    reads run concurrently under WAL, and writes are serialized in one thread
+
+    Args:
+        db_file: database file
+        workers: number of threads for reads
+
+    Examples:
+        >>> import asyncio
+        >>> import tempfile
+        >>>
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> adb = AsyncSQLite(f'{tmp.name}/daily.db')
+        >>> async def main():
+        ...     await adb.upsert_frame('daily', data=pd.DataFrame({
+        ...         'ticker': ['ES1', 'NQ1'], 'price': [3000, 9000],
+        ...     }), primary_key='ticker')
+        ...     res = await asyncio.gather(*[
+        ...         adb.select('daily', ticker=ticker) for ticker in ['ES1', 'NQ1']
+        ...     ])
+        ...     return [r['price'].tolist() for r in res]
+        >>> loop = asyncio.new_event_loop()
+        >>> loop.run_until_complete(main())
+        [[3000], [9000]]
+        >>> loop.close()
+        >>> adb.close()
+        >>> tmp.cleanup()
+    """
+
+    def __init__(self, db_file, workers=ASYNC_WORKERS):
+
+        self.db = SQLite(db_file)
+        self._readers_ = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xone-xql-read')
+        self._writer_ = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xone-xql-write')
+
+    async def _read_(self, method: str, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(
+            self._readers_, partial(getattr(self.db, method), *args, **kwargs)
+        )
+
+    async def _write_(self, method: str, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(
+            self._writer_, partial(getattr(self.db, method), *args, **kwargs)
+        )
+
+    async def tables(self) -> list:
+        return await self._read_('tables')
+
+    async def columns(self, table: str) -> list:
+        return await self._read_('columns', table=table)
+
+    async def select(self, table: str, cond='', **kwargs) -> pd.DataFrame:
+        return await self._read_('select', table=table, cond=cond, **kwargs)
+
+    async def select_recent(self, table: str, dateperiod: str, **kwargs) -> pd.DataFrame:
+        return await self._read_('select_recent', table=table, dateperiod=dateperiod, **kwargs)
+
+    async def explain(self, table: str, cond='', **kwargs) -> list:
+        return await self._read_('explain', table=table, cond=cond, **kwargs)
+
+    async def indexes(self, table: str) -> pd.DataFrame:
+        return await self._read_('indexes', table=table)
+
+    async def replace_into(self, table: str, data: pd.DataFrame = None, **kwargs):
+        return await self._write_('replace_into', table=table, data=data, **kwargs)
+
+    async def upsert_frame(self, table: str, data: pd.DataFrame, **kwargs):
+        return await self._write_('upsert_frame', table=table, data=data, **kwargs)
+
+    async def create_index(self, table: str, columns, **kwargs) -> str:
+        return await self._write_('create_index', table=table, columns=columns, **kwargs)
+
+    async def drop_index(self, name: str):
+        return await self._write_('drop_index', name=name)
+
+    def close(self):
+        """
+        Wait for pending queries and close connections of worker threads
+        """
+        self._readers_.shutdown(wait=True)
+        self._writer_.shutdown(wait=True)
+        self.db._prune_()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_event_loop().run_in_executor(None, self.close)
+
+
+class WriteBuffer(object):
+    """
+    Write-behind buffer of records to replace into tables - records are accumulated and
+    written with executemany in one transaction when max_rows are pending, when the oldest
+    pending record is older than interval (in seconds), or on `flush` / `close` / exit
+
+    Callers are blocked when max_pending records are not yet written (back-pressure),
+    and batches failed to write are logged and dropped
+
+    Args:
+        db_file: database file
+        max_rows: number of pending records to trigger write
+        interval: max seconds for records to stay in buffer
+        max_pending: max number of records in buffer and being written
+
+    Examples:
+        >>> import tempfile
+        >>>
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> db = SQLite(f'{tmp.name}/status.db')
+        >>> with db: _ = db.con.execute('CREATE TABLE status (job text primary key, state text)')
+        >>> buf = WriteBuffer(f'{tmp.name}/status.db', interval=60)
+        >>> buf.replace_into('status', job='px', state='running')
+        >>> buf.replace_into('status', state='paused', job='px')
+        >>> buf.replace_into('status', job='px', state='done')
+        >>> db.select('status').shape[0]
+        0
+        >>> buf.close()
+        >>> db.select('status').values.tolist()
+        [['px', 'done']]
+        >>> import time
+        >>>
+        >>> buf = WriteBuffer(f'{tmp.name}/status.db', interval=.1)
+        >>> for state in ['running', 'done']:
+        ...     buf.replace_into('status', job='vol', state=state)
+        ...     time.sleep(.5)
+        ...     db.select('status', job='vol')['state'].tolist()
+        ['running']
+        ['done']
+        >>> buf.close()
+
+        Failed batches are dropped and later records are still written
+
+        >>> buf = WriteBuffer(f'{tmp.name}/status.db', max_rows=1, max_pending=1)
+        >>> buf.replace_into('status', job='px', state=2 ** 63)
+        >>> buf.replace_into('status', job='px', state='failed')
+        >>> buf.close()
+        >>> db.select('status', job='px')['state'].tolist()
+        ['failed']
+        >>> db.close()
+        >>> tmp.cleanup()
+    """
+
+    def __init__(
+            self,
+            db_file,
+            max_rows=WRITE_ROWS,
+            interval=WRITE_INTERVAL,
+            max_pending=WRITE_MAX_PENDING,
+    ):
+
+        self.db = SQLite(db_file)
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_pending = max(max_pending, max_rows)
+        self._reset_()
+        atexit.register(self.close)
+
+    def _reset_(self):
+        """
+        Empty buffer of current process - records of parent process are not written after fork
+        """
+        # Runs of consecutive records of the same table and columns: [(table, columns), rows]
+        self._records_ = []
+        # Records in buffer and being written
+        self._pending_ = 0
+        self._first_ = None
+        self._cond_ = threading.Condition()
+        self._write_lock_ = threading.Lock()
+        self._thread_ = None
+        self._closed_ = False
+        self._pid_ = os.getpid()
+
+    def replace_into(self, table: str, **kwargs):
+        """
+        Add record to buffer - blocked if buffer is full
+        """
+        if self._pid_ != os.getpid(): self._reset_()
+        # Columns in the same order regardless of order of kwargs
+        cols = tuple(sorted(kwargs))
+        key, row = (table, cols), tuple(bind_value(kwargs[c]) for c in cols)
+        with self._cond_:
+            if self._closed_: raise RuntimeError('WriteBuffer is closed')
+            if self._thread_ is None:
+                self._thread_ = threading.Thread(
+                    target=self._run_, name='xone-xql-write-behind', daemon=True,
+                )
+                self._thread_.start()
+            while self._pending_ >= self.max_pending:
+                self._cond_.notify_all()
+                self._cond_.wait()
+            if self._records_ and (self._records_[-1][0] == key):
+                self._records_[-1][1].append(row)
+            else:
+                self._records_.append([key, [row]])
+            self._pending_ += 1
+            if self._first_ is None:
+                # Writer waits for the interval from the oldest record on
+                self._first_ = time.monotonic()
+                self._cond_.notify_all()
+            elif self._pending_ >= self.max_rows:
+                self._cond_.notify_all()
+
+    def flush(self) -> int:
+        """
+        Write all records in buffer
+
+        Returns:
+            int: number of records written
+        """
+        # Batches are written in order
+        with self._write_lock_:
+            with self._cond_:
+                records, self._records_, self._first_ = self._records_, [], None
+            total = sum(len(rows) for _, rows in records)
+            if not total: return 0
+            try:
+                with self.db._transaction_() as con:
+                    # Runs are written in order of records, so later values win
+                    for (table, cols), rows in records:
+                        con.executemany(
+                            f'REPLACE INTO `{table}` ({", ".join(f"`{c}`" for c in cols)}) '
+                            f'VALUES ({", ".join(["?"] * len(cols))})',
+                            rows,
+                        )
+            except Exception as e:
+                # Writer keeps running - otherwise callers are blocked once buffer is full
+                logs.get_logger(WriteBuffer, types='stream').error(
+                    f'Cannot write {total} records to {self.db.db_file}: {e}'
+                )
+                return 0
+            finally:
+                with self._cond_:
+                    self._pending_ -= total
+                    self._cond_.notify_all()
+            return total
+
+    def _run_(self):
+        """
+        Write records in background when size or time threshold is hit
+        """
+        while True:
+            with self._cond_:
+                while not self._closed_:
+                    if self._pending_ >= self.max_rows: break
+                    timeout = None
+                    if self._first_ is not None:
+                        timeout = self.interval - (time.monotonic() - self._first_)
+                        if timeout <= 0: break
+                    self._cond_.wait(timeout=timeout)
+                closed = self._closed_
+            self.flush()
+            if closed: return
+
+    def close(self):
+        """
+        Write all pending records and stop background writes
+        """
+        if self._pid_ != os.getpid(): return
+        with self._cond_:
+            if self._closed_: return
+            self._closed_ = True
+            atexit.unregister(self.close)
+            self._cond_.notify_all()
+            thread = self._thread_
+        if thread is not None: thread.join()
+        self.flush()
+
+
+def frame_rows(data: pd.DataFrame, chunk_size=CHUNK_SIZE):
+    """
+    Rows of DataFrame in chunks as database values, without per-row conversion
+    Columns are converted to python values from underlying arrays, missing values as None
+
+    Args:
+        data: DataFrame
+        chunk_size: number of rows in each chunk
+
+    Yields:
+        iterator of row tuples for each chunk
+
+    Examples:
+        >>> sample = pd.DataFrame({
+        ...     'ticker': ['ES1', None, 'VG1'],
+        ...     'price': [3000, 3010, 3020],
+        ...     'date': pd.to_datetime(['2020-01-02', None, '2020-01-06']),
+        ... })
+        >>> [list(rows) for rows in frame_rows(sample, chunk_size=2)]
+        [[('ES1', 3000, '2020-01-02 00:00:00'), (None, 3010, None)], [('VG1', 3020, '2020-01-06 00:00:00')]]
+    """
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data.iloc[start:start + chunk_size]
+        yield zip(*[db_values(chunk.iloc[:, n]) for n in range(chunk.shape[1])])
+
+
+def is_full_scan(detail: str) -> bool:
+    """
+    Whether step of query plan scans full table without index
+
+    Examples:
+        >>> is_full_scan('SCAN daily'), is_full_scan('SCAN TABLE daily')
+        (True, True)
+        >>> is_full_scan('SCAN daily USING COVERING INDEX idx_daily_ticker')
+        False
+        >>> is_full_scan('SEARCH daily USING INDEX idx_daily_ticker (ticker=?)')
+        False
+    """
+    return detail.startswith('SCAN ') and (' USING ' not in detail)
+
+
+def num_dtype(decl: str) -> str:
+    """
+    Dtype of numeric column by declared type with SQLite affinity rules - empty for others
+
+    Examples:
+        >>> [num_dtype(decl) for decl in ['INTEGER', 'BIGINT', 'REAL', 'DOUBLE', 'TEXT', '']]
+        ['Int64', 'Int64', 'float64', 'float64', '', '']
+    """
+    decl = (decl or '').upper()
+    if 'INT' in decl: return 'Int64'
+    if any(t in decl for t in ['REAL', 'FLOA', 'DOUB']): return 'float64'
+    return ''
+
+
+def sql_type(dtype) -> str:
+    """
+    SQLite column type of dtype
+
+    Examples:
+        >>> [sql_type(dt) for dt in ['int64', 'bool', 'float32', 'datetime64[ns]', 'object']]
+        ['INTEGER', 'INTEGER', 'REAL', 'TEXT', 'TEXT']
+        >>> sql_type(pd.Int64Dtype())
+        'INTEGER'
+    """
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype): return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype): return 'REAL'
+    return 'TEXT'
+
+
+def db_values(values: pd.Series) -> list:
+    """
+    Column values as python values that can be bound to queries
+    Dates and times are formatted the same as `bind_value`
+
+    Examples:
+        >>> db_values(pd.Series(pd.to_datetime(['2020-01-02 10:00', None])))
+        ['2020-01-02 10:00:00', None]
+        >>> db_values(pd.Series([pd.Timestamp('2020-01-02 10:00:00.123456'), pd.Timestamp('2020-01-02 10:00')]))
+        ['2020-01-02 10:00:00.123456', '2020-01-02 10:00:00']
+        >>> db_values(pd.Series(pd.to_datetime(['2020-01-02 10:00']).tz_localize('UTC')))
+        ['2020-01-02 10:00:00+00:00']
+        >>> db_values(pd.Series(pd.to_timedelta(['1h', None])))
+        ['0 days 01:00:00', None]
+    """
+    missing = values.isna()
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        frac = (values.dt.microsecond != 0) | (values.dt.nanosecond != 0)
+        if (values.dt.tz is None) and (not frac.any()):
+            values = values.dt.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            # Fractional seconds and tz offsets are kept as in str of timestamps
+            values = values.map(str)
+    elif pd.api.types.is_timedelta64_dtype(values.dtype):
+        values = values.map(str)
+    elif isinstance(values.dtype, np.dtype) and (values.dtype.kind in 'biuf'):
+        # NaN is stored as NULL by SQLite
+        return values.values.tolist()
+    return values.astype(object).where(~missing, None).tolist()
 
 
 def db_value(val) -> str:
@@ -209,9 +1104,13 @@ def select(table: str, cond='', **kwargs) -> str:
         'price > 3000'
         >>> select('daily')
         'SELECT * FROM `daily`'
+        >>> q4 = select('daily', ticker=['ES1 Index', 'NQ1 Index'])
+        >>> q4.splitlines()[-2].strip()
+        'ticker IN ("ES1 Index", "NQ1 Index")'
     """
     all_cond = [cond] + [
-        f'{key}={db_value(value)}'
+        f'{key} IN ({", ".join(map(db_value, value))})'
+        if isinstance(value, (list, tuple, set)) else f'{key}={db_value(value)}'
         for key, value in kwargs.items()
     ]
     where = ' AND '.join(filter(bool, all_cond))
@@ -245,3 +1144,85 @@ def replace_into(table: str, **kwargs) -> str:
         REPLACE INTO `{table}` ({', '.join(list(kwargs.keys()))})
         VALUES ({', '.join(map(db_value, list(kwargs.values())))})
     """
+
+
+def bind_value(val):
+    """
+    Python value to bind to query parameters
+    Strings are stripped and double quotes removed, as in `db_value` of query strings
+
+    Examples:
+        >>> bind_value(np.int64(3000)), bind_value(pd.Timestamp('2020-01-02')), bind_value(None)
+        (3000, '2020-01-02 00:00:00', None)
+        >>> bind_value(' "ES1 Index" ')
+        'ES1 Index'
+        >>> bind_value(np.datetime64('2020-01-02T10:00:00.123456'))
+        '2020-01-02 10:00:00.123456'
+        >>> bind_value(datetime.timedelta(hours=1)), bind_value(pd.Timedelta('1h'))
+        ('0 days 01:00:00', '0 days 01:00:00')
+    """
+    if isinstance(val, str): return val.replace('"', '').strip()
+    if (val is None) or isinstance(val, (int, float, bytes)): return val
+    if isinstance(val, (datetime.datetime, np.datetime64)): return str(pd.Timestamp(val))
+    if isinstance(val, (datetime.timedelta, np.timedelta64)): return str(pd.Timedelta(val))
+    if isinstance(val, np.generic): return val.item()
+    return str(val)
+
+
+def select_query(table: str, cond='', **kwargs) -> tuple:
+    """
+    Parameterized SELECT statement with values to bind
+    Statements of the same shape are identical and reused from statement cache of connection
+
+    Args:
+        table: table name
+        cond: conditions
+        **kwargs: data as kwargs - lists / tuples / sets as IN (...)
+
+    Returns:
+        tuple: (query, params)
+
+    Examples:
+        >>> select_query('daily', ticker='ES1 Index', price=3000)
+        ('SELECT * FROM `daily` WHERE `ticker` = ? AND `price` = ?', ['ES1 Index', 3000])
+        >>> select_query('daily', cond='price > 3000', ticker=['ES1 Index', 'NQ1 Index'])
+        ('SELECT * FROM `daily` WHERE price > 3000 AND `ticker` IN (?, ?)', ['ES1 Index', 'NQ1 Index'])
+        >>> select_query('daily')
+        ('SELECT * FROM `daily`', [])
+    """
+    all_cond, params = [cond], []
+    for key, value in kwargs.items():
+        if isinstance(value, (list, tuple, set)):
+            value = list(value)
+            all_cond.append(f'`{key}` IN ({", ".join(["?"] * len(value))})')
+            params += [bind_value(v) for v in value]
+        else:
+            all_cond.append(f'`{key}` = ?')
+            params.append(bind_value(value))
+    where = ' AND '.join(filter(bool, all_cond))
+    q_str = f'SELECT * FROM `{table}`'
+    if where: q_str += f' WHERE {where}'
+    return q_str, params
+
+
+def replace_query(table: str, **kwargs) -> tuple:
+    """
+    Parameterized REPLACE INTO statement with values to bind
+
+    Args:
+        table: table name
+        **kwargs: data as kwargs
+
+    Returns:
+        tuple: (query, params)
+
+    Examples:
+        >>> replace_query('daily', ticker='ES1 Index', price=3000)
+        ('REPLACE INTO `daily` (`ticker`, `price`) VALUES (?, ?)', ['ES1 Index', 3000])
+    """
+    cols = ', '.join(f'`{k}`' for k in kwargs)
+    vals = ', '.join(['?'] * len(kwargs))
+    return (
+        f'REPLACE INTO `{table}` ({cols}) VALUES ({vals})',
+        [bind_value(v) for v in kwargs.values()],
+    )